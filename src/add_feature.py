@@ -0,0 +1,95 @@
+import numpy as np
+import argparse
+import json
+import os
+
+from region_store import RegionStore, list_region_stores
+from rasterio_backend import resample_to_grid, RESAMPLING_METHODS
+from slope_unit_index import has_pixel_index, read_pixel_index, build_pixel_index, indexed_zonal_stats
+from slope_unit_processor import feature_stat_names
+import profiling
+
+def read_output_grid(store, metadata=None):
+    """Grid (transform, shape, CRS) of a stage-3 region store, as taken by resample_to_grid."""
+    metadata = store.read_metadata() if metadata is None else metadata
+    height, width = store.read_array('slope_units').shape
+    return {
+        'transform': metadata['transform'],
+        'width': width,
+        'height': height,
+        'crs': metadata['crs'],
+    }
+
+@profiling.profiled
+def add_region_feature(region_path, feature, raster_path, categorical=False, interpolation_method=None):
+    """
+    Add one feature to a stage-3 region store: resample raster_path onto the
+    region grid, compute its per-unit statistics through the stored pixel
+    index and add (or replace) its columns in the X table.
+
+    Returns:
+        list of str: the X columns written.
+    """
+    store = RegionStore(region_path)
+    metadata = store.read_metadata()
+    if not has_pixel_index(store):
+        # stores written before stage 3 persisted the index
+        build_pixel_index(store.read_array('slope_units'), metadata['n_units'], store=store)
+    order, offsets = read_pixel_index(store)
+
+    if interpolation_method is None:
+        interpolation_method = 'nearest' if categorical else 'bicubic'
+    raster = resample_to_grid(raster_path, read_output_grid(store, metadata), interpolation_method=interpolation_method)
+    # same cropping as stage 1, where crop_raster's if(x, x, null()) turns zeros into nodata
+    raster[raster == 0] = np.nan
+
+    columns = feature_stat_names(feature, categorical)
+    stats = indexed_zonal_stats(raster, order, offsets, stats=columns.values(), nodata=np.nan)
+    kept = store.read_array('kept_su_ids', mmap_mode=None) - 1
+    X = store.read_table('X')
+    for column, stat in columns.items():
+        X[column] = stats[stat][kept].astype(np.float32)
+    store.write_table('X', X)
+    return list(columns)
+
+def add_feature(output_dir, feature, raster_path, categorical=False, interpolation_method=None, regions=None, data_json_path=None):
+    """
+    Add one feature to every stage-3 region store in output_dir (or the listed
+    regions) without rerunning stages 1-3. raster_path may contain '{region}'
+    to use a per-region raster. With data_json_path, the feature is also
+    registered there so later full runs include it; this needs a single
+    existing raster, since stage 1 reads one source file per feature.
+    """
+    if data_json_path is not None:
+        if '{region}' in raster_path:
+            raise ValueError(f"Cannot register per-region raster '{raster_path}' in {data_json_path}: stage 1 needs a single source raster")
+        if not os.path.exists(raster_path):
+            raise FileNotFoundError(f"Cannot register missing raster '{raster_path}' in {data_json_path}")
+
+    for region in list_region_stores(output_dir):
+        if regions is not None and region not in regions:
+            continue
+        print('Adding feature to region: ', region)
+        with profiling.region(region):
+            add_region_feature(os.path.join(output_dir, region), feature, raster_path.format(region=region),
+                categorical=categorical, interpolation_method=interpolation_method)
+
+    if data_json_path is not None:
+        with open(data_json_path, 'r') as f:
+            data_files = json.load(f)
+        data_files['categorical_features' if categorical else 'features'][feature] = raster_path
+        with open(data_json_path, 'w') as f:
+            json.dump(data_files, f, indent=4)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Add one feature to existing stage-3 outputs through the slope-unit pixel index.')
+    parser.add_argument('--output_dir', type=str, required=True, help='stage-3 output directory of region stores')
+    parser.add_argument('--feature', type=str, required=True)
+    parser.add_argument('--raster_path', type=str, required=True, help="feature raster; may contain '{region}'")
+    parser.add_argument('--categorical', action='store_true')
+    parser.add_argument('--interpolation_method', type=str, default=None, choices=list(RESAMPLING_METHODS))
+    parser.add_argument('--regions', type=str, nargs='+', default=None)
+    parser.add_argument('--data_json_path', type=str, default=None, help='also register the feature in this data_files.json')
+    args = parser.parse_args()
+    add_feature(args.output_dir, args.feature, args.raster_path, categorical=args.categorical,
+        interpolation_method=args.interpolation_method, regions=args.regions, data_json_path=args.data_json_path)
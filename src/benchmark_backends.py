@@ -0,0 +1,72 @@
+from grass_region_processor import *
+import rasterio_backend
+import pandas as pd
+import time
+
+def benchmark_region(region_id, region_file, output_dir, feature_sources, categorical_features):
+    """
+    Crop/resample/export every feature of one region with both backends, timing
+    each and comparing the two outputs pixel by pixel.
+    """
+    grass_dir = os.path.join(output_dir, region_id, 'grass')
+    rasterio_dir = os.path.join(output_dir, region_id, 'rasterio')
+    setup_dir(grass_dir)
+    setup_dir(rasterio_dir)
+
+    grass_utils.import_vector(region_file, region_id)
+    grass_utils.set_subregion_bounds(region_id, 'elevation')
+    grass_utils.rasterize_vmap(region_id, verbose=True)
+    region_path = os.path.join(grass_dir, 'region.tif')
+    crop_and_export(f'{region_id}_raster', region_id, region_path, interpolation_method='nearest')
+    grid = rasterio_backend.read_region_grid(region_path)
+
+    rows = []
+    for feature, source_path in feature_sources.items():
+        interpolation_method = 'nearest' if feature in categorical_features else 'bicubic'
+        grass_path = os.path.join(grass_dir, f'{feature}.tif')
+        rasterio_path = os.path.join(rasterio_dir, f'{feature}.tif')
+
+        start = time.perf_counter()
+        crop_and_export(feature, region_id, grass_path, interpolation_method=interpolation_method)
+        grass_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rasterio_backend.crop_and_export_rasterio(source_path, grid, rasterio_path, interpolation_method=interpolation_method)
+        rasterio_time = time.perf_counter() - start
+
+        rows.append({
+            'region': region_id,
+            'feature': feature,
+            'method': interpolation_method,
+            'grass_s': grass_time,
+            'rasterio_s': rasterio_time,
+            **rasterio_backend.compare_rasters(grass_path, rasterio_path),
+        })
+    return rows
+
+def run_benchmark(data_json_path, regions_dir, output_dir):
+    with open(data_json_path, 'r') as f:
+        data_files = json.load(f)
+    feature_sources = {'elevation': data_files['elevation'], **data_files['features'], **data_files['categorical_features']}
+    categorical_features = list(data_files['categorical_features'].keys())
+
+    rows = []
+    for region_id in get_region_files(regions_dir):
+        print('Benchmarking region: ', region_id)
+        rows += benchmark_region(region_id, os.path.join(regions_dir, f'{region_id}.shp'), output_dir, feature_sources, categorical_features)
+    results = pd.DataFrame(rows)
+    results.to_csv(os.path.join(output_dir, 'backend_benchmark.csv'), index=False)
+
+    per_region = results.groupby('region')[['grass_s', 'rasterio_s']].sum()
+    per_region['speedup'] = per_region['grass_s'] / per_region['rasterio_s']
+    print(per_region.to_string())
+    print(results[['region', 'feature', 'nodata_agreement', 'within_tolerance', 'max_abs_diff']].to_string(index=False))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-region wall time and agreement of the GRASS and rasterio feature backends.')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--regions_dir', type=str, required=True)
+    parser.add_argument('--data_json_path', type=str, required=True)
+    args = parser.parse_args()
+    run_benchmark(args.data_json_path, args.regions_dir, args.output_dir)
@@ -0,0 +1,150 @@
+import numpy as np
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic_data import write_synthetic_region
+from region_store import RegionStore
+
+BENCHMARKS = (
+    'compute_slopeunit_centroids',
+    'stack_tif_files',
+    'map_raster_to_slu',
+    'zonal_stats',
+    'aggregate_region_streaming',
+    'stage2_stage3',
+)
+
+# each _setup_<name> imports its modules and loads its inputs, then returns the call to time
+
+def _setup_compute_slopeunit_centroids(region_dir, work_dir, categorical):
+    from slope_unit_aggregate import compute_slopeunit_centroids
+    return lambda: compute_slopeunit_centroids(os.path.join(region_dir, 'slopeunits.tif'))
+
+def _setup_stack_tif_files(region_dir, work_dir, categorical):
+    from slope_unit_aggregate import stack_tif_files
+    return lambda: stack_tif_files(region_dir)
+
+def _load_feature_and_labels(region_dir):
+    from slope_unit_aggregate import load_tif_numpy
+    return load_tif_numpy(os.path.join(region_dir, 'feature_0.tif')), load_tif_numpy(os.path.join(region_dir, 'slopeunits.tif'))
+
+def _setup_map_raster_to_slu(region_dir, work_dir, categorical):
+    from slope_unit_processor import map_raster_to_slu
+    raster, slope_units = _load_feature_and_labels(region_dir)
+    return lambda: map_raster_to_slu(raster, slope_units, reduce_fn=np.mean)
+
+def _setup_zonal_stats(region_dir, work_dir, categorical):
+    # same statistic as the map_raster_to_slu benchmark, so the two are directly comparable
+    from zonal_stats import zonal_stats
+    raster, slope_units = _load_feature_and_labels(region_dir)
+    return lambda: zonal_stats(raster, slope_units, stats=['mean'])
+
+def _setup_aggregate_region_streaming(region_dir, work_dir, categorical):
+    from slope_unit_aggregate import aggregate_region_streaming
+    return lambda: aggregate_region_streaming(region_dir, RegionStore.create(os.path.join(work_dir, 'streaming')), categorical)
+
+def _setup_stage2_stage3(region_dir, work_dir, categorical):
+    from slope_unit_aggregate import aggregate_region
+    from slope_unit_processor import process_region_slopeunits
+    store_path = os.path.join(work_dir, 'aggregated')
+    def run():
+        aggregate_region(region_dir, RegionStore.create(store_path), categorical)
+        process_region_slopeunits(store_path, 5, os.path.join(work_dir, 'output'), categorical_feature_names=categorical)
+    return run
+
+def _benchmark_child(name, region_dir, work_dir, categorical, queue):
+    # runs in a fresh process so peak RSS belongs to this benchmark alone; imports and input loading are not timed
+    run = globals()[f'_setup_{name}'](region_dir, work_dir, categorical)
+    start = time.perf_counter()
+    run()
+    wall = time.perf_counter() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({'wall_s': wall, 'peak_rss_mb': (maxrss if sys.platform == 'darwin' else maxrss * 1024) / 2 ** 20})
+
+def run_case(name, region_dir, work_dir, categorical):
+    """Run one benchmark in a spawned process and return its wall time and peak RSS."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_benchmark_child, args=(name, region_dir, work_dir, categorical, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {'status': f'failed (exit code {process.exitcode})'}
+    return {'status': 'ok', **queue.get()}
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(pixels_list, units_list, n_features, n_categorical, output_file, benchmarks=BENCHMARKS, loop_budget=1e10, work_dir=None, seed=0):
+    """
+    Time the numpy stages on synthetic regions at every (pixels, units) scale
+    point and append one JSON record per benchmark to output_file. The
+    per-unit loop of map_raster_to_slu is skipped where pixels x units exceeds
+    loop_budget.
+    """
+    run_info = {
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'host': platform.node(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    base_dir = tempfile.mkdtemp(prefix='slu_bench_', dir=work_dir)
+    records = []
+    try:
+        for pixels in pixels_list:
+            side = int(round(np.sqrt(pixels)))
+            for n_units in units_list:
+                region_dir = os.path.join(base_dir, f'region_{side}_{n_units}')
+                print(f'Generating {side}x{side} region with {n_units} slope units and {n_features} features')
+                categorical = write_synthetic_region(region_dir, side, side, n_units, n_features=n_features, n_categorical=n_categorical, seed=seed)
+                for name in benchmarks:
+                    record = {
+                        **run_info,
+                        'benchmark': name,
+                        'pixels': side * side,
+                        'height': side,
+                        'width': side,
+                        'n_units': n_units,
+                        'n_features': n_features,
+                    }
+                    if name == 'map_raster_to_slu' and side * side * n_units > loop_budget:
+                        record['status'] = 'skipped'
+                    else:
+                        case_dir = tempfile.mkdtemp(dir=base_dir)
+                        record.update(run_case(name, region_dir, case_dir, categorical))
+                        shutil.rmtree(case_dir, ignore_errors=True)
+                    print(f"  {name:30s} {record['status']:8s} {record.get('wall_s', float('nan')):10.3f}s {record.get('peak_rss_mb', float('nan')):10.1f} MB")
+                    records.append(record)
+                    with open(output_file, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+                shutil.rmtree(region_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    return records
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='GRASS-free benchmark suite for stages 2 and 3 on synthetic regions.')
+    parser.add_argument('--output_file', type=str, default='benchmark_results.jsonl')
+    parser.add_argument('--pixels', type=float, nargs='+', default=[1e6, 1e7])
+    parser.add_argument('--units', type=float, nargs='+', default=[1e3, 1e4])
+    parser.add_argument('--n_features', type=int, default=4)
+    parser.add_argument('--n_categorical', type=int, default=1)
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=list(BENCHMARKS), choices=BENCHMARKS)
+    parser.add_argument('--loop_budget', type=float, default=1e10, help='max pixels x units for the per-unit loop')
+    parser.add_argument('--work_dir', type=str, default=None, help='where synthetic regions are written')
+    args = parser.parse_args()
+    run_suite([int(p) for p in args.pixels], [int(u) for u in args.units], args.n_features, args.n_categorical, args.output_file,
+        benchmarks=args.benchmarks, loop_budget=args.loop_budget, work_dir=args.work_dir)
@@ -0,0 +1,45 @@
+import numpy as np
+import argparse
+import time
+
+from slope_unit_processor import compute_feature_stats
+from zonal_stats import count_units
+from synthetic_data import make_synthetic_region
+
+def time_engine(raster, slope_units, stats, engine, n_units):
+    start = time.perf_counter()
+    result = compute_feature_stats(raster, slope_units, stats, engine=engine, n_units=n_units)
+    return time.perf_counter() - start, result
+
+def run_benchmark(height, width, n_units, repeats=1):
+    slope_units, continuous, categorical = make_synthetic_region(height, width, n_units)
+    n_units = count_units(slope_units)
+    cases = [
+        ('continuous', continuous, ['mean', 'var', 'min', 'max']),
+        ('categorical', categorical, ['mode']),
+    ]
+    print(f"raster {height}x{width}, {n_units} slope units")
+    for name, raster, stats in cases:
+        timings = {}
+        results = {}
+        for engine in ['loop', 'vectorized']:
+            best = np.inf
+            for _ in range(repeats):
+                elapsed, results[engine] = time_engine(raster, slope_units, stats, engine, n_units)
+                best = min(best, elapsed)
+            timings[engine] = best
+        for stat in stats:
+            np.testing.assert_allclose(results['vectorized'][stat], results['loop'][stat], rtol=1e-4, atol=1e-3,
+                err_msg=f"{name}/{stat} differs between engines")
+        speedup = timings['loop'] / timings['vectorized']
+        print(f"  {name:12s} {','.join(stats):18s} loop {timings['loop']:8.3f}s  vectorized {timings['vectorized']:8.3f}s  speedup {speedup:7.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the per-unit loop and vectorized zonal statistics engines.')
+    parser.add_argument('--height', type=int, default=1000)
+    parser.add_argument('--width', type=int, default=1000)
+    parser.add_argument('--n_units', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--repeats', type=int, default=1)
+    args = parser.parse_args()
+    for n in args.n_units:
+        run_benchmark(args.height, args.width, n, repeats=args.repeats)
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import time
+
+HASH_CHUNK_SIZE = 1 << 20
+
+# shapefile components that make up one vector input
+VECTOR_SIDECARS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+def hash_value(value):
+    """Stable digest of a JSON-serialisable value (dict keys are sorted)."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+def vector_files(path):
+    """All existing shapefile components belonging to path (any of its sidecar extensions)."""
+    base = os.path.splitext(path)[0]
+    return [base + ext for ext in VECTOR_SIDECARS if os.path.exists(base + ext)]
+
+def list_files(path):
+    """Every file under a directory (recursively, sorted), or [path] for a file."""
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for root, dirs, filenames in os.walk(path):
+        dirs.sort()
+        files += [os.path.join(root, filename) for filename in sorted(filenames)]
+    return files
+
+def code_version(*source_files):
+    """Digest of the given source files, so code edits invalidate the stages they feed."""
+    return hash_value({os.path.basename(path): _hash_file_contents(path) for path in source_files})
+
+def _hash_file_contents(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class BuildCache:
+    """
+    Content-addressed record of which (stage, region) outputs are up to date.
+
+    A stage's key is the hash of all its inputs (file contents, parameters,
+    code version). After a stage finishes for a region, record() writes a
+    manifest with the key and the output files; on the next run is_fresh()
+    compares keys and the stage is skipped if nothing changed.
+
+    File contents are hashed once and memoised by (size, mtime), so unchanged
+    multi-GB rasters are not re-read on every run. With force=True nothing is
+    considered fresh, but manifests are still written for the next run.
+    """
+
+    def __init__(self, cache_dir, force=False):
+        self.cache_dir = cache_dir
+        self.force = force
+        os.makedirs(os.path.join(cache_dir, 'manifests'), exist_ok=True)
+        self._hash_index_path = os.path.join(cache_dir, 'file_hashes.json')
+        self._hash_index = {}
+        if os.path.exists(self._hash_index_path):
+            with open(self._hash_index_path, 'r') as f:
+                self._hash_index = json.load(f)
+
+    def hash_file(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self._hash_index.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+        digest = _hash_file_contents(path)
+        self._hash_index[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+        return digest
+
+    def hash_files(self, paths):
+        """Digest of a set of files or directories, keyed by their relative names."""
+        hashes = {}
+        for path in paths:
+            for file_path in list_files(path):
+                hashes[os.path.relpath(file_path, os.path.dirname(os.path.abspath(path)))] = self.hash_file(file_path)
+        return hash_value(hashes)
+
+    def stage_key(self, **inputs):
+        """Combine named input digests/parameters into one stage key."""
+        return hash_value(inputs)
+
+    def _manifest_path(self, stage, region_id):
+        return os.path.join(self.cache_dir, 'manifests', stage, f'{region_id}.json')
+
+    def is_fresh(self, stage, region_id, key):
+        """True if the stage already ran for region_id with the same key and its outputs still exist."""
+        manifest_path = self._manifest_path(stage, region_id)
+        if self.force or not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        return manifest['key'] == key and all(os.path.exists(path) for path in manifest['outputs'])
+
+    def record(self, stage, region_id, key, outputs):
+        manifest_path = self._manifest_path(stage, region_id)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(manifest_path, 'w') as f:
+            json.dump({'key': key, 'outputs': list(outputs), 'time': time.time()}, f, indent=2)
+        self.save()
+
+    def save(self):
+        tmp_path = self._hash_index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._hash_index, f)
+        os.replace(tmp_path, self._hash_index_path)
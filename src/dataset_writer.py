@@ -0,0 +1,153 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import argparse
+import json
+import os
+import shutil
+
+from region_store import RegionStore, list_region_stores
+import profiling
+
+INDEX_FILE = 'index.json'
+# rows per shard file; a region is never split across shards, so shards may run over by one region
+DEFAULT_ROWS_PER_SHARD = 1 << 20
+DEFAULT_ROW_GROUP_SIZE = 1 << 16
+
+def region_table(store, region, columns=None):
+    """
+    Per-unit rows of a stage-3 region store as an Arrow table: region, su_id,
+    centroid_x, centroid_y, count, y and (when stage 1 exported the inventory
+    area fraction) y_fraction, followed by the X feature columns.
+    """
+    X = store.read_table('X', columns=columns)
+    centroids = store.read_array('centroids', mmap_mode=None)
+    n_rows = len(X)
+    table = pa.table({
+        'region': pa.array([region] * n_rows, type=pa.string()).dictionary_encode(),
+        'su_id': store.read_array('kept_su_ids', mmap_mode=None).astype(np.int64),
+        'centroid_x': centroids[:, 0],
+        'centroid_y': centroids[:, 1],
+        'count': store.read_array('counts', mmap_mode=None).astype(np.int64),
+        'y': store.read_array('y', mmap_mode=None).astype(np.float32),
+    })
+    if store.has_array('y_fraction'):
+        table = table.append_column('y_fraction', pa.array(store.read_array('y_fraction', mmap_mode=None).astype(np.float32)))
+    for column in X.columns:
+        table = table.append_column(column, pa.array(X[column].to_numpy(dtype=np.float32)))
+    return table
+
+@profiling.profiled
+def export_dataset(output_dir, dataset_dir, columns=None, regions=None, rows_per_shard=DEFAULT_ROWS_PER_SHARD, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    """
+    Stream the per-unit rows of every stage-3 region store in output_dir into
+    one sharded Parquet dataset at dataset_dir, one region at a time. Each
+    region is written as whole row groups of a single shard, and index.json
+    records where, so any region's rows can be read without scanning the rest.
+
+    Layout::
+
+        <dataset_dir>/part-00000.parquet, part-00001.parquet, ...
+        <dataset_dir>/index.json
+
+    Returns:
+        dict: the index.
+    """
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    os.makedirs(dataset_dir)
+
+    index = {'columns': None, 'n_rows': 0, 'shards': [], 'regions': {}}
+    writer, schema = None, None
+    try:
+        for region in list_region_stores(output_dir):
+            if regions is not None and region not in regions:
+                continue
+            table = region_table(RegionStore(os.path.join(output_dir, region)), region, columns=columns)
+            if schema is None:
+                schema = table.schema
+                index['columns'] = schema.names
+            elif set(table.schema.names) != set(schema.names):
+                raise ValueError(f"Region {region} has columns {table.schema.names}, expected {schema.names}")
+            # regions may list the same features in a different order
+            table = table.select(schema.names).cast(schema)
+
+            shard = index['shards'][-1] if index['shards'] else None
+            if shard is None or (shard['n_rows'] > 0 and shard['n_rows'] + len(table) > rows_per_shard):
+                if writer is not None:
+                    writer.close()
+                shard = {'file': f"part-{len(index['shards']):05d}.parquet", 'n_rows': 0, 'n_row_groups': 0}
+                index['shards'].append(shard)
+                writer = pq.ParquetWriter(os.path.join(dataset_dir, shard['file']), schema)
+
+            n_row_groups = -(-len(table) // row_group_size)
+            if len(table):
+                writer.write_table(table, row_group_size=row_group_size)
+            index['regions'][region] = {
+                'shard': len(index['shards']) - 1,
+                'row_groups': [shard['n_row_groups'], shard['n_row_groups'] + n_row_groups],
+                'shard_offset': shard['n_rows'],
+                'offset': index['n_rows'],
+                'n_rows': len(table),
+            }
+            shard['n_rows'] += len(table)
+            shard['n_row_groups'] += n_row_groups
+            index['n_rows'] += len(table)
+            print(f'Exported region {region}: {len(table)} rows')
+    finally:
+        if writer is not None:
+            writer.close()
+
+    with open(os.path.join(dataset_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+class ShardedDataset:
+    """
+    Reader for a dataset written by export_dataset. Regions are looked up in
+    the index and read from their own row groups; the full study area can be
+    streamed in batches with memory bounded by the batch size.
+    """
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+        with open(os.path.join(dataset_dir, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+
+    def __len__(self):
+        return self.index['n_rows']
+
+    @property
+    def columns(self):
+        return self.index['columns']
+
+    @property
+    def regions(self):
+        return list(self.index['regions'])
+
+    def _shard_path(self, shard):
+        return os.path.join(self.dataset_dir, self.index['shards'][shard]['file'])
+
+    def read_region(self, region, columns=None):
+        """Rows of one region as a DataFrame, reading only its row groups."""
+        entry = self.index['regions'][region]
+        first, last = entry['row_groups']
+        table = pq.ParquetFile(self._shard_path(entry['shard'])).read_row_groups(list(range(first, last)), columns=columns)
+        return table.to_pandas()
+
+    def iter_batches(self, columns=None, batch_size=DEFAULT_ROW_GROUP_SIZE):
+        """Yield DataFrames of at most batch_size rows over all shards, in region order."""
+        for shard in range(len(self.index['shards'])):
+            for batch in pq.ParquetFile(self._shard_path(shard)).iter_batches(batch_size=batch_size, columns=columns):
+                yield batch.to_pandas()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export stage-3 region stores into one sharded Parquet dataset.')
+    parser.add_argument('--output_dir', type=str, required=True, help='stage-3 output directory of region stores')
+    parser.add_argument('--dataset_dir', type=str, required=True)
+    parser.add_argument('--columns', type=str, nargs='+', default=None, help='X columns to export (default: all)')
+    parser.add_argument('--rows_per_shard', type=int, default=DEFAULT_ROWS_PER_SHARD)
+    parser.add_argument('--row_group_size', type=int, default=DEFAULT_ROW_GROUP_SIZE)
+    args = parser.parse_args()
+    export_dataset(args.output_dir, args.dataset_dir, columns=args.columns,
+        rows_per_shard=args.rows_per_shard, row_group_size=args.row_group_size)
@@ -1,22 +1,111 @@
-from setup import *
+from setup import get_config_manager, get_region_files
+# GRASS must be initialised before grass_utils / grass.script are imported
+config_manager = get_config_manager()
 import grass_utils
 from utils import setup_dir
 import grass.script as gs
 import argparse
 import os
 import json
+import logging
+import traceback
+import shutil
+import uuid
+from multiprocessing import Pool, current_process
 
-def crop_and_export(raster_name, mask_name, file_path, interpolation_method='bicubic', **kwargs):
+import build_cache as bc
+import rasterio_backend
+import tile_stitching
+import profiling
+
+# r.slopeunits configuration used for every region
+SLOPEUNITS_PARAMS = {
+    'thresh': 800000,
+    'cvmin': 0.4,
+    'areamin': 40000,
+    'rf': 10,
+    'maxiteration': 100,
+    'cleansize': 20000,
+}
+
+def crop_and_export(raster_name, mask_name, file_path, interpolation_method='bicubic', resample_cache=None, **kwargs):
     print(interpolation_method)
-    interpolated_name = grass_utils.interpolate_raster(raster_name, interpolation_method=interpolation_method)
+    if resample_cache is not None:
+        interpolated_name = resample_cache.get(raster_name, interpolation_method=interpolation_method)
+    else:
+        interpolated_name = grass_utils.interpolate_raster(raster_name, interpolation_method=interpolation_method)
     cropped_name = grass_utils.crop_raster(interpolated_name, mask_name, **kwargs)
     grass_utils.export_raster(cropped_name, output_file=file_path, **kwargs)
+    return cropped_name
 
 def import_all_features(feature_paths, **kwargs):
     for feature_name, feature_path in feature_paths.items():
         grass_utils.import_raster(feature_path, feature_name, **kwargs)
 
-def subregion_processor(region_id, region_file, output_directory, continuous_features, categorical_features, **kwargs):
+def warm_resample_cache(region_ids, region_files, continuous_features, categorical_features, feature_backends=None):
+    """
+    Resample every feature once over the union extent of all regions, aligned to
+    the DEM, so that each region only crops from the cached maps. Features on
+    the rasterio backend are skipped.
+    """
+    feature_backends = {} if feature_backends is None else feature_backends
+    resample_cache = grass_utils.ResampleCache()
+    for region_id, region_file in zip(region_ids, region_files):
+        grass_utils.import_vector(region_file, region_id)
+    grass_utils.clear_region_mask()
+    profiling.run_command('g.region', vector=','.join(region_ids), align='elevation')
+    features = [(feature, 'bicubic') for feature in continuous_features] + [(feature, 'nearest') for feature in categorical_features]
+    for feature, interpolation_method in features:
+        if feature == 'elevation' or feature_backends.get(feature, 'grass') == 'grass':
+            resample_cache.warm(feature, interpolation_method=interpolation_method)
+    return resample_cache
+
+def rasterize_shared_layers(region_ids, fraction_supersample=None):
+    """
+    Rasterize the landslide inventory and the boundaries of all regions once,
+    over the union extent of region_ids aligned to the DEM, so that every
+    region only crops from the shared maps instead of rerunning v.to.rast on
+    the full inventory. The region vectors must already be imported (see
+    warm_resample_cache). With fraction_supersample, the per-pixel landslide
+    area fraction is rasterized as well, from a grid that many times finer.
+
+    Returns:
+        dict: layer ('regions', 'inventory', 'inventory_fraction') -> GRASS map name.
+    """
+    grass_utils.clear_region_mask()
+    profiling.run_command('g.region', vector=','.join(region_ids), align='elevation')
+    profiling.run_command('v.patch', input=','.join(region_ids), output='all_regions', overwrite=True)
+    grass_utils.rasterize_vmap('all_regions', binarize=True)
+    grass_utils.rasterize_vmap('inventory', binarize=True)
+    shared_rasters = {'regions': 'all_regions_raster', 'inventory': 'inventory_raster'}
+    if fraction_supersample:
+        shared_rasters['inventory_fraction'] = grass_utils.rasterize_fraction('inventory', supersample=fraction_supersample)
+    return shared_rasters
+
+def crop_and_export_shared(raster_name, mask_name, file_path, **kwargs):
+    """Crop a map already on the DEM grid (see rasterize_shared_layers) to the current region and mask and export it."""
+    cropped_name = grass_utils.crop_raster(raster_name, mask_name)
+    grass_utils.export_raster(cropped_name, output_file=file_path, **kwargs)
+    return cropped_name
+
+def prepare_region(region_id, region_file, output_directory, continuous_features, categorical_features, resample_cache=None,
+        feature_sources=None, feature_backends=None, shared_rasters=None, **kwargs):
+    """
+    Everything of stage 1 that does not depend on the slope units: set the
+    region and mask, and export region.tif, the features and the inventory.
+    feature_backends maps feature names to 'grass' (default) or 'rasterio';
+    rasterio features are resampled straight from their source file in
+    feature_sources onto the grid of region.tif without any GRASS module calls.
+    The DEM always goes through GRASS since r.slopeunits needs it as a map.
+    With shared_rasters (from rasterize_shared_layers), region.tif and the
+    inventory (and inventory_fraction.tif) are cropped from the shared maps.
+
+    Returns:
+        str: name of the cropped DEM map to segment.
+    """
+    feature_sources = {} if feature_sources is None else feature_sources
+    feature_backends = {} if feature_backends is None else feature_backends
+
     # create output directory
     region_out_dir = os.path.join(output_directory, region_id)
     setup_dir(region_out_dir)
@@ -27,42 +116,195 @@ def subregion_processor(region_id, region_file, output_directory, continuous_fea
     # 2. update bounds to sub-region
     grass_utils.set_subregion_bounds(region_id, 'elevation')
 
-    # # 7. crop and export MAP, PGA, soil data
-    for feature in continuous_features:
-        crop_and_export(feature, region_id, os.path.join(region_out_dir, f'{feature}.tif'), interpolation_method='bicubic')
-    for feature in categorical_features:
-        crop_and_export(feature, region_id, os.path.join(region_out_dir, f'{feature}.tif'), interpolation_method='nearest')
+    # 3. rasterize region bounds (its grid and mask are the target of the rasterio backend)
+    region_path = os.path.join(region_out_dir, f'region.tif')
+    if shared_rasters is not None:
+        crop_and_export_shared(shared_rasters['regions'], region_id, region_path)
+    else:
+        grass_utils.rasterize_vmap(region_id, verbose=True)
+        crop_and_export(f'{region_id}_raster', region_id, region_path, interpolation_method='nearest')
+
+    # 4. crop and export DEM, MAP, PGA, soil data
+    cropped = {}
+    region_grid = None
+    features = [(feature, 'bicubic') for feature in continuous_features] + [(feature, 'nearest') for feature in categorical_features]
+    for feature, interpolation_method in features:
+        file_path = os.path.join(region_out_dir, f'{feature}.tif')
+        if feature != 'elevation' and feature_backends.get(feature, 'grass') == 'rasterio':
+            region_grid = rasterio_backend.read_region_grid(region_path) if region_grid is None else region_grid
+            with profiling.step('crop_and_export_rasterio', kind='rasterio', feature=feature):
+                rasterio_backend.crop_and_export_rasterio(feature_sources[feature], region_grid, file_path, interpolation_method=interpolation_method)
+        else:
+            cropped[feature] = crop_and_export(feature, region_id, file_path, interpolation_method=interpolation_method, resample_cache=resample_cache)
 
-    # 3. rasterize landslide inventory
-    grass_utils.rasterize_vmap('inventory', verbose=True, binarize=True)
-    crop_and_export('inventory_raster', region_id, os.path.join(region_out_dir, f'inventory.tif'), interpolation_method='nearest')
+    # 5. rasterize landslide inventory
+    if shared_rasters is not None:
+        crop_and_export_shared(shared_rasters['inventory'], region_id, os.path.join(region_out_dir, f'inventory.tif'))
+        if 'inventory_fraction' in shared_rasters:
+            crop_and_export_shared(shared_rasters['inventory_fraction'], region_id, os.path.join(region_out_dir, f'inventory_fraction.tif'))
+    else:
+        grass_utils.rasterize_vmap('inventory', verbose=True, binarize=True)
+        crop_and_export('inventory_raster', region_id, os.path.join(region_out_dir, f'inventory.tif'), interpolation_method='nearest')
+    return cropped['elevation']
 
-    # 4. rasterize region bounds
-    grass_utils.rasterize_vmap(region_id, verbose=True)
-    crop_and_export(f'{region_id}_raster', region_id, os.path.join(region_out_dir, f'region.tif'), interpolation_method='nearest')
+def segment_region(region_id, dem_map, region_out_dir, slopeunits_params=None, map_prefix=None):
+    """
+    Run r.slopeunits on a prepared DEM map under the current region and mask
+    and export the result as slopeunits.tif in region_out_dir.
+    """
+    slopeunits_params = SLOPEUNITS_PARAMS if slopeunits_params is None else slopeunits_params
+    map_prefix = region_id if map_prefix is None else map_prefix
 
-    # 5. generate slope units
-    slu_map_intermediate = f'{region_id}_slu_intermediate'
-    slu_map = f'{region_id}_slu'
+    # 6. generate slope units
+    slu_map_intermediate = f'{map_prefix}_slu_intermediate'
+    slu_map = f'{map_prefix}_slu'
     grass_utils.run_slopeunits(
-        demmap = f'{region_id}_elevation_interp',
+        demmap = dem_map,
         slumap = slu_map_intermediate,
         slumapclean = slu_map,
-        thresh = 800000,
-        cvmin = 0.4,
-        areamin = 40000,
-        rf = 10,
-        maxiteration = 100,
-        cleansize = 20000,
-        overwrite = True
+        overwrite = True,
+        **slopeunits_params
     )
 
-    # 6. rasterize and store slopeunits
+    # 7. rasterize and store slopeunits
     grass_utils.export_raster(slu_map, 
         output_file=os.path.join(region_out_dir, 'slopeunits.tif'), type='UInt32'
     )
 
-def process_subregions(data_json_path, regions_dir, output_dir):
+def _init_tile_worker(mapset_prefix, source_mapset):
+    config_manager.use_temp_mapset(f'{mapset_prefix}{os.getpid()}')
+    # the prepared DEM lives in the parent's mapset, which may itself be a temporary one
+    if source_mapset not in ('PERMANENT', config_manager.config['MAPSET']):
+        profiling.run_command('g.mapsets', mapset=source_mapset, operation='add')
+
+def _segment_tile_task(task):
+    region_id, dem_map, tile, region, tile_path, slopeunits_params = task
+    i, j = tile['index']
+    map_prefix = f'{region_id}_tile_{i}_{j}'
+    with profiling.region(region_id), profiling.step('segment_tile', tile=f'{i}_{j}'):
+        profiling.run_command('g.region', nsres=region['nsres'], ewres=region['ewres'], **tile_stitching.tile_bounds(tile['extent'], region))
+        grass_utils.run_slopeunits(
+            demmap = dem_map,
+            slumap = f'{map_prefix}_slu_intermediate',
+            slumapclean = f'{map_prefix}_slu',
+            overwrite = True,
+            **slopeunits_params
+        )
+        grass_utils.export_raster(f'{map_prefix}_slu', output_file=tile_path, type='UInt32')
+    return tile_path
+
+def segment_region_tiled(region_id, dem_map, region_out_dir, pixel_budget, halo=tile_stitching.DEFAULT_HALO, workers=1, slopeunits_params=None):
+    """
+    segment_region for regions too large for one r.slopeunits run: split the
+    current region into tiles of at most pixel_budget pixels including a halo
+    of overlap, segment the tiles (in parallel with workers > 1, each in a
+    temporary mapset), and stitch them into one slopeunits.tif with globally
+    unique, contiguous IDs (see tile_stitching.stitch_tiles).
+    """
+    slopeunits_params = SLOPEUNITS_PARAMS if slopeunits_params is None else slopeunits_params
+    region = gs.region()
+    tiles = tile_stitching.plan_tiles(region['rows'], region['cols'], pixel_budget, halo=halo)
+    tile_dir = os.path.join(region_out_dir, 'tiles')
+    setup_dir(tile_dir)
+    tasks = [
+        (region_id, dem_map, tile, region, os.path.join(tile_dir, f"tile_{tile['index'][0]}_{tile['index'][1]}.tif"), slopeunits_params)
+        for tile in tiles
+    ]
+    print(f"Segmenting region {region_id} ({region['rows']}x{region['cols']}) in {len(tiles)} tiles")
+
+    if workers > 1 and len(tasks) > 1 and not current_process().daemon:
+        mapset_prefix = f'tmp_tile_{uuid.uuid4().hex[:8]}_'
+        try:
+            with Pool(processes=min(workers, len(tasks)), initializer=_init_tile_worker, initargs=(mapset_prefix, gs.gisenv()['MAPSET'])) as pool:
+                tile_paths = pool.map(_segment_tile_task, tasks)
+        finally:
+            config_manager.remove_temp_mapsets(mapset_prefix)
+    else:
+        # region pool workers are daemons and cannot start pools of their own
+        tile_paths = [_segment_tile_task(task) for task in tasks]
+        grass_utils.set_subregion_bounds(region_id, 'elevation')
+
+    labels = tile_stitching.stitch_tiles(tiles, tile_paths, region['rows'], region['cols'])
+    tile_stitching.write_labels(labels, os.path.join(region_out_dir, 'slopeunits.tif'), os.path.join(region_out_dir, 'region.tif'))
+    shutil.rmtree(tile_dir)
+
+def subregion_processor(region_id, region_file, output_directory, continuous_features, categorical_features,
+        tile_pixel_budget=None, tile_halo=tile_stitching.DEFAULT_HALO, tile_workers=1, **kwargs):
+    """
+    Stage 1 for one region: prepare_region followed by segment_region, or by
+    segment_region_tiled when the region has more than tile_pixel_budget pixels.
+    """
+    dem_map = prepare_region(region_id, region_file, output_directory, continuous_features, categorical_features, **kwargs)
+    region_out_dir = os.path.join(output_directory, region_id)
+    region = gs.region()
+    if tile_pixel_budget is not None and region['rows'] * region['cols'] > tile_pixel_budget:
+        segment_region_tiled(region_id, dem_map, region_out_dir, tile_pixel_budget, halo=tile_halo, workers=tile_workers)
+    else:
+        segment_region(region_id, dem_map, region_out_dir)
+
+def _init_region_worker(mapset_prefix):
+    # each pool process gets a private mapset so g.region / r.mask state is not shared
+    config_manager.use_temp_mapset(f'{mapset_prefix}{os.getpid()}')
+
+def _region_task(task):
+    region_id, region_file, output_dir, processor_kwargs = task
+    resample_cache = processor_kwargs.get('resample_cache')
+    cache_before = resample_cache.stats() if resample_cache is not None else {}
+    try:
+        with profiling.region(region_id), profiling.step('subregion_processor'):
+            subregion_processor(region_id, region_file, output_dir, **processor_kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    # hit/miss counts of this region only, so pool workers' copies can be summed
+    cache_stats = {key: value - cache_before[key] for key, value in resample_cache.stats().items()} if resample_cache is not None else {}
+    return region_id, error, cache_stats
+
+def stage_key(build_cache, region_file, data_files, feature_backends, use_resample_cache=True, tiling=None, inventory_fraction=None):
+    """
+    Build-cache key of stage 1 for one region: its vector, all source data,
+    r.slopeunits parameters, the options that change the exported rasters
+    (backends, resample cache, tiling, inventory fraction) and code.
+    """
+    source_files = bc.vector_files(data_files['inventory']) + [data_files['elevation']]
+    source_files += list(data_files['features'].values()) + list(data_files['categorical_features'].values())
+    return build_cache.stage_key(
+        region=build_cache.hash_files(bc.vector_files(region_file)),
+        sources=build_cache.hash_files(source_files),
+        slopeunits_params=SLOPEUNITS_PARAMS,
+        feature_backends=feature_backends,
+        use_resample_cache=use_resample_cache,
+        tiling=tiling,
+        inventory_fraction=inventory_fraction,
+        code=bc.code_version(__file__, grass_utils.__file__, rasterio_backend.__file__, tile_stitching.__file__),
+    )
+
+def process_subregions(data_json_path, regions_dir, output_dir, workers=1, build_cache=None, use_resample_cache=True, feature_backend='grass',
+        regions=None, on_region_done=None, tile_pixel_budget=None, tile_halo=tile_stitching.DEFAULT_HALO, tile_workers=1,
+        inventory_fraction_supersample=None):
+    """
+    Run stage 1 for every region vector in regions_dir.
+
+    With workers > 1 regions are processed in a process pool, each worker in its
+    own temporary mapset reading the shared imported layers from PERMANENT. A
+    failing region does not stop the others. With a build_cache, regions whose
+    inputs are unchanged since their last successful run are skipped. With
+    use_resample_cache, each feature is resampled, and the inventory and region
+    boundaries are rasterized, once over the union extent of the regions to
+    process and every region crops from that; inventory_fraction_supersample
+    also exports the landslide area fraction as inventory_fraction.tif (this
+    needs use_resample_cache). feature_backend
+    ('grass' or 'rasterio') selects how features are cropped and exported; the
+    optional 'feature_backends' mapping in data_files.json overrides it per
+    feature. regions restricts the run to a subset of region IDs, and
+    on_region_done(region_id) is called as soon as a region has succeeded (or
+    was skipped as unchanged). Regions with more than tile_pixel_budget pixels
+    are segmented in overlapping tiles of tile_halo pixels, tile_workers at a
+    time, and stitched (see segment_region_tiled).
+
+    Returns:
+        dict: region ID -> traceback string for every region that failed.
+    """
     with open(data_json_path, 'r') as f:
         data_files = json.load(f)
 
@@ -77,14 +319,88 @@ def process_subregions(data_json_path, regions_dir, output_dir):
     # import_all_features(feature_paths, resample='bicubic')
     continuous_features = ['elevation'] + list(feature_paths.keys())
     categorical_features = list(categorical_feature_paths.keys())
+    feature_sources = {'elevation': dem_path, **feature_paths, **categorical_feature_paths}
+    feature_backends = {feature: feature_backend for feature in feature_sources}
+    feature_backends.update(data_files.get('feature_backends', {}))
 
     # configure output directory
     setup_dir(output_dir)
 
     region_list = get_region_files(regions_dir)
-    for region_id in region_list:
-        print('Processing region: ', region_id)
-        subregion_processor(region_id, os.path.join(regions_dir, f'{region_id}.shp'), output_dir, continuous_features, categorical_features)
+    if regions is not None:
+        regions = set(regions)
+        region_list = [region_id for region_id in region_list if region_id in regions]
+    processor_kwargs = {
+        'continuous_features': continuous_features,
+        'categorical_features': categorical_features,
+        'feature_sources': feature_sources,
+        'feature_backends': feature_backends,
+        'tile_pixel_budget': tile_pixel_budget,
+        'tile_halo': tile_halo,
+        'tile_workers': tile_workers,
+    }
+    tiling = {'pixel_budget': tile_pixel_budget, 'halo': tile_halo} if tile_pixel_budget is not None else None
+    tasks = [
+        (region_id, os.path.join(regions_dir, f'{region_id}.shp'), output_dir, processor_kwargs)
+        for region_id in region_list
+    ]
+
+    keys = {}
+    if build_cache is not None:
+        keys = {task[0]: stage_key(build_cache, task[1], data_files, feature_backends, use_resample_cache=use_resample_cache, tiling=tiling,
+            inventory_fraction=inventory_fraction_supersample) for task in tasks}
+        skipped = [task[0] for task in tasks if build_cache.is_fresh('stage1', task[0], keys[task[0]])]
+        if skipped:
+            print(f'Skipping {len(skipped)} unchanged regions: ', skipped)
+        tasks = [task for task in tasks if task[0] not in skipped]
+        if on_region_done is not None:
+            for region_id in skipped:
+                on_region_done(region_id)
+
+    cache_stats = {'hits': 0, 'misses': 0}
+    if use_resample_cache and tasks:
+        resample_cache = warm_resample_cache([task[0] for task in tasks], [task[1] for task in tasks],
+            continuous_features, categorical_features, feature_backends=feature_backends)
+        cache_stats['misses'] += resample_cache.misses
+        processor_kwargs['resample_cache'] = resample_cache
+        processor_kwargs['shared_rasters'] = rasterize_shared_layers([task[0] for task in tasks],
+            fraction_supersample=inventory_fraction_supersample)
+    elif inventory_fraction_supersample:
+        raise ValueError('inventory_fraction_supersample needs use_resample_cache')
+
+    failures = {}
+    def collect(region_id, error, region_cache_stats):
+        if error is not None:
+            failures[region_id] = error
+        else:
+            if build_cache is not None:
+                build_cache.record('stage1', region_id, keys[region_id], [os.path.join(output_dir, region_id)])
+            if on_region_done is not None:
+                on_region_done(region_id)
+        for key, value in region_cache_stats.items():
+            cache_stats[key] += value
+
+    if workers <= 1:
+        for task in tasks:
+            print('Processing region: ', task[0])
+            collect(*_region_task(task))
+    else:
+        mapset_prefix = f'tmp_slu_{uuid.uuid4().hex[:8]}_'
+        try:
+            with Pool(processes=workers, initializer=_init_region_worker, initargs=(mapset_prefix,)) as pool:
+                for region_id, error, region_cache_stats in pool.imap_unordered(_region_task, tasks):
+                    print('Finished region: ', region_id, '' if error is None else '(failed)')
+                    collect(region_id, error, region_cache_stats)
+        finally:
+            config_manager.remove_temp_mapsets(mapset_prefix)
+
+
+    for region_id, error in failures.items():
+        logging.error(f"Region {region_id} failed:\n{error}")
+    print(f'Processed {len(tasks) - len(failures)}/{len(tasks)} regions')
+    if use_resample_cache:
+        print(f"Resample cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    return failures
 
 if __name__ == "__main__":
     # handle arguments
@@ -92,6 +408,16 @@ if __name__ == "__main__":
     parser.add_argument('--output_dir', type=str, required=True)
     parser.add_argument('--regions_dir', type=str, required=True)
     parser.add_argument('--data_json_path', type=str, required=True)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--no_resample_cache', action='store_true')
+    parser.add_argument('--feature_backend', type=str, default='grass', choices=rasterio_backend.FEATURE_BACKENDS)
+    parser.add_argument('--tile_pixel_budget', type=int, default=None)
+    parser.add_argument('--tile_halo', type=int, default=tile_stitching.DEFAULT_HALO)
+    parser.add_argument('--tile_workers', type=int, default=1)
+    parser.add_argument('--inventory_fraction_supersample', type=int, default=None)
     args = parser.parse_args()
 
-    process_subregions(args.data_json_path, args.regions_dir, args.output_dir)
\ No newline at end of file
+    process_subregions(args.data_json_path, args.regions_dir, args.output_dir, workers=args.workers,
+        use_resample_cache=not args.no_resample_cache, feature_backend=args.feature_backend,
+        tile_pixel_budget=args.tile_pixel_budget, tile_halo=args.tile_halo, tile_workers=args.tile_workers,
+        inventory_fraction_supersample=args.inventory_fraction_supersample)
\ No newline at end of file
@@ -2,6 +2,9 @@ import grass.script as gs
 import grass
 import logging
 import os
+import hashlib
+
+from profiling import run_command
 
 def generate_flags(flag_list = None, **kwargs):
     flags = ''.join(flag_list) if flag_list else ''
@@ -13,22 +16,29 @@ def generate_flags(flag_list = None, **kwargs):
 def apply_region_mask(mask_name, **kwargs):
     logging.info(f"Applying Mask: {mask_name}")
     flags = generate_flags([], **kwargs)
-    gs.run_command('g.region', vector=mask_name)
+    run_command('g.region', vector=mask_name)
     try:
-        gs.run_command('r.mask', vector=mask_name, flags=flags)
+        run_command('r.mask', vector=mask_name, flags=flags)
     except grass.exceptions.CalledModuleError:
-        gs.run_command('r.mask', flags=['r']) # remove existing mask
-        gs.run_command('r.mask', vector=mask_name, flags=flags)
+        run_command('r.mask', flags=['r']) # remove existing mask
+        run_command('r.mask', vector=mask_name, flags=flags)
 
 def remove_region_mask(mask_name, **kwargs):
     logging.info(f"Removing Mask: {mask_name}")
     flags = generate_flags(['r'], **kwargs)
-    gs.run_command('r.mask', flags=flags)
+    run_command('r.mask', flags=flags)
+
+def clear_region_mask():
+    # r.mask -r fails when no mask is set
+    try:
+        run_command('r.mask', flags=['r'])
+    except grass.exceptions.CalledModuleError:
+        pass
 
 def rasterize_vmap(vector_name, binarize=False, **kwargs):
     logging.info(f"Rasterizing vector {vector_name}")
     flags = generate_flags(['o'], **kwargs)
-    gs.run_command('v.to.rast',
+    run_command('v.to.rast',
         input = vector_name,
         output = 'temp_raster',
         flags = flags,
@@ -36,27 +46,101 @@ def rasterize_vmap(vector_name, binarize=False, **kwargs):
         use = 'cat'
     )
     if binarize:
-        gs.run_command('r.mapcalc', expression = f"{vector_name}_raster = if(isnull(temp_raster), 0, 1)", overwrite=True)
-        gs.run_command('g.remove', type='raster', name='temp_raster', flags=['f'])
+        run_command('r.mapcalc', expression = f"{vector_name}_raster = if(isnull(temp_raster), 0, 1)", overwrite=True)
+        run_command('g.remove', type='raster', name='temp_raster', flags=['f'])
     else:
-        gs.run_command('g.rename', raster=f'temp_raster,{vector_name}_raster', overwrite=True)
+        run_command('g.rename', raster=f'temp_raster,{vector_name}_raster', overwrite=True)
+
+def rasterize_fraction(vector_name, supersample=5, **kwargs):
+    """
+    Per-pixel fraction of the current region's cells covered by vector_name:
+    rasterize on a grid supersample times finer and average back onto the
+    current grid. Returns the name of the fraction map.
+    """
+    logging.info(f"Rasterizing {vector_name} coverage fraction")
+    region = gs.region()
+    bounds = {side: region[side] for side in ('n', 's', 'e', 'w')}
+    run_command('g.region', nsres=region['nsres'] / supersample, ewres=region['ewres'] / supersample, **bounds)
+    run_command('v.to.rast', input=vector_name, output='temp_fine_raster', use='val', value=1, overwrite=True)
+    run_command('r.mapcalc', expression="temp_fine_cover = if(isnull(temp_fine_raster), 0, 1)", overwrite=True)
+    run_command('g.region', nsres=region['nsres'], ewres=region['ewres'], **bounds)
+    run_command('r.resamp.stats', input='temp_fine_cover', output=f'{vector_name}_fraction', method='average', overwrite=True)
+    run_command('g.remove', type='raster', name='temp_fine_raster,temp_fine_cover', flags=['f'])
+    return f'{vector_name}_fraction'
 
 def crop_raster(raster_name, mask_name, dem='clipped_wenchuan_dem'):
     logging.info(f"Cropping {raster_name}")
-    # gs.run_command('g.region', vector=mask_name, align=dem)
-    gs.run_command('r.mapcalc', expression = f"{mask_name}_{raster_name}= if({raster_name}, {raster_name}, null())", overwrite=True)
+    # run_command('g.region', vector=mask_name, align=dem)
+    run_command('r.mapcalc', expression = f"{mask_name}_{raster_name}= if({raster_name}, {raster_name}, null())", overwrite=True)
     return f"{mask_name}_{raster_name}"
 
-def interpolate_raster(raster_name, interpolation_method='bicubic'):
+def interpolate_raster(raster_name, interpolation_method='bicubic', out_name=None):
     logging.info(f"Resampling {raster_name}")
-    out_name = f'{raster_name}_interp'
-    gs.run_command('r.resamp.interp', input=raster_name, output=out_name, method=interpolation_method, overwrite=True)
+    out_name = f'{raster_name}_interp' if out_name is None else out_name
+    run_command('r.resamp.interp', input=raster_name, output=out_name, method=interpolation_method, overwrite=True)
     return out_name
 
+class ResampleCache:
+    '''
+    Cache of r.resamp.interp outputs keyed by (raster, method, resolution and
+    grid alignment, extent). A lookup hits when a cached map was resampled with
+    the same method onto the same grid over an extent that contains the current
+    region, so regions only need to crop from it. Misses resample over the
+    current region and are added to the cache.
+
+    warm() resamples over the current region up front; call it under the union
+    extent of all regions (and with no mask) to resample each raster once.
+    '''
+
+    def __init__(self):
+        self.entries = []
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _grid(region):
+        return (
+            round(region['nsres'], 9), round(region['ewres'], 9),
+            round(region['w'] % region['ewres'], 6), round(region['n'] % region['nsres'], 6),
+        )
+
+    @staticmethod
+    def _contains(extent, region, tol=1e-6):
+        return (extent['n'] + tol >= region['n'] and extent['s'] - tol <= region['s']
+            and extent['e'] + tol >= region['e'] and extent['w'] - tol <= region['w'])
+
+    def _resample(self, raster_name, interpolation_method, region):
+        grid = self._grid(region)
+        extent = {side: region[side] for side in ('n', 's', 'e', 'w')}
+        digest = hashlib.sha1(repr((raster_name, interpolation_method, grid, sorted(extent.items()))).encode()).hexdigest()[:10]
+        out_name = interpolate_raster(raster_name, interpolation_method=interpolation_method, out_name=f'{raster_name}_interp_{digest}')
+        self.entries.append({'raster': raster_name, 'method': interpolation_method, 'grid': grid, 'extent': extent, 'map': out_name})
+        return out_name
+
+    def warm(self, raster_name, interpolation_method='bicubic'):
+        self.misses += 1
+        return self._resample(raster_name, interpolation_method, gs.region())
+
+    def get(self, raster_name, interpolation_method='bicubic'):
+        region = gs.region()
+        grid = self._grid(region)
+        for entry in self.entries:
+            if (entry['raster'] == raster_name and entry['method'] == interpolation_method
+                    and entry['grid'] == grid and self._contains(entry['extent'], region)):
+                self.hits += 1
+                logging.info(f"Resample cache hit for {raster_name}: {entry['map']}")
+                return entry['map']
+        self.misses += 1
+        logging.info(f"Resample cache miss for {raster_name}")
+        return self._resample(raster_name, interpolation_method, region)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
 def import_vector(input_file, map_name, **kwargs):
     logging.info(f"Importing vector {map_name}")
     flags = generate_flags(['w', 'o'], **kwargs)
-    gs.run_command('v.import',
+    run_command('v.import',
         input = input_file,
         output = map_name,
         overwrite = True,
@@ -66,7 +150,7 @@ def import_vector(input_file, map_name, **kwargs):
 def import_raster(input_file, map_name, resample='bicubic', **kwargs):
     logging.info(f"Importing raster {map_name}")
     flags = generate_flags(['o'], **kwargs)
-    gs.run_command('r.import',
+    run_command('r.import',
         input = input_file,
         output = map_name,
         overwrite = True,
@@ -79,7 +163,7 @@ def export_raster(map_name, output_file, type='Float32', **kwargs):
     flags = "f"
     if type in ['Byte', 'UInt16']:
         flags += "c"
-    gs.run_command('r.out.gdal',
+    run_command('r.out.gdal',
         input = map_name,
         output = output_file,
         format = 'GTiff',
@@ -89,8 +173,8 @@ def export_raster(map_name, output_file, type='Float32', **kwargs):
     )
 
 def set_subregion_bounds(region_id, dem):
-    gs.run_command('g.region', vector=region_id, align=dem)
-    gs.run_command('g.region', flags='p')
+    run_command('g.region', vector=region_id, align=dem)
+    run_command('g.region', flags='p')
 
     apply_region_mask(region_id, verbose=True)
     # maybe extend the region a little bit so that post-processing, slope units have appropriate boundaries
@@ -103,7 +187,7 @@ def set_subregion_bounds(region_id, dem):
     #     'nsres': region['nsres'],
     #     'ewres': region['ewres']
     # }
-    # gs.run_command('g.region', n=new_region['n'], s=new_region['s'], e=new_region['e'], w=new_region['w'], res=new_region['nsres'], flags='p')
+    # run_command('g.region', n=new_region['n'], s=new_region['s'], e=new_region['e'], w=new_region['w'], res=new_region['nsres'], flags='p')
 
 def run_slopeunits(
         demmap,
@@ -123,7 +207,7 @@ def run_slopeunits(
     '''
     kwargs['overwrite'] = True
     flags = generate_flags(['m'], **kwargs)
-    gs.run_command('r.slopeunits',
+    run_command('r.slopeunits',
         demmap = demmap, slumap = slumap, thresh = thresh, cvmin = cvmin, areamin = areamin, rf = rf, maxiteration = maxiteration, flags = 'm', cleansize = cleansize, slumapclean = slumapclean, overwrite=True) #  **kwargs
 
 # `r.slopeunits --overwrite demmap=elev30m@PERMANENT slumap=slope_units_6_10k thresh=500000 cvmin=0.6 areamin=10000 areamax=1000000 rf=10 maxiteration=1000`
@@ -1,36 +1,120 @@
 import os
 import argparse
+import time
 
 from utils import setup_dir, clean_dir
-from grass_region_processor import process_subregions
-from slope_unit_aggregate import aggregate_slope_units
+from build_cache import BuildCache
+from pipeline_state import PipelineState, STAGES, select_stages
+from setup import get_region_files
+import profiling
+from slope_unit_aggregate import aggregate_slope_units, list_region_dirs
 from slope_unit_processor import process_slopeunits
+from region_store import list_region_stores
+from dataset_writer import export_dataset
+from tile_stitching import DEFAULT_HALO
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--output_dir', type=str, required=True)
-    parser.add_argument('--region_vector_dir', type=str, required=True)
+    parser.add_argument('--region_vector_dir', type=str, default=None, help='required when stage 1 runs')
     parser.add_argument('--data_json_path', type=str, required=True)
     parser.add_argument('--min_slu_count', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=1, help='parallel GRASS workers for stage 1')
+    parser.add_argument('--no_resample_cache', action='store_true', help='resample features per region instead of once')
+    parser.add_argument('--feature_backend', type=str, default='grass', choices=['grass', 'rasterio'],
+        help='crop/resample/export backend for features (DEM always uses GRASS)')
+    parser.add_argument('--tile_pixel_budget', type=int, default=None, help='segment regions with more pixels than this in overlapping tiles')
+    parser.add_argument('--tile_halo', type=int, default=DEFAULT_HALO, help='tile overlap in pixels')
+    parser.add_argument('--tile_workers', type=int, default=1, help='parallel r.slopeunits runs per tiled region')
+    parser.add_argument('--inventory_fraction_supersample', type=int, default=None,
+        help='also rasterize the per-pixel landslide area fraction from a grid this many times finer')
+    parser.add_argument('--zonal_engine', type=str, default='vectorized', choices=['vectorized', 'loop'])
+    parser.add_argument('--streaming', action='store_true', help='windowed out-of-core aggregation in stage 2')
+    parser.add_argument('--window_pixels', type=int, default=1 << 24)
+    parser.add_argument('--prefetch', type=int, default=0,
+        help='stages 2-3: regions read ahead in background threads while the current one is computed (0: sequential)')
     parser.add_argument('--clean_dumps', action='store_true')
+    parser.add_argument('--force', action='store_true', help='ignore the build cache and rebuild every region')
+    parser.add_argument('--no_trace', action='store_true', help='do not record a timing trace of this run')
+    parser.add_argument('--stages', type=int, nargs='+', default=None, choices=STAGES, help='stages to run (default: all)')
+    parser.add_argument('--from_stage', type=int, default=None, choices=STAGES, help='skip the stages before this one')
+    parser.add_argument('--dataset_dir', type=str, default=None, help='also export all stage-3 rows to one sharded Parquet dataset here')
+    parser.add_argument('--resume', action='store_true', help='skip (stage, region) pairs completed by an earlier run')
     args = parser.parse_args()
 
+    stages = select_stages(args.stages, args.from_stage)
+    if 1 in stages and args.region_vector_dir is None:
+        parser.error('--region_vector_dir is required when stage 1 runs')
+
+    # per-run trace of every GRASS module call and stage function (wall/CPU time, peak RSS)
+    trace_dir = os.path.join(args.output_dir, 'traces', time.strftime('%Y%m%d_%H%M%S'))
+    if not args.no_trace:
+        profiling.enable(trace_dir)
+
+    # content-addressed manifests of finished (stage, region) pairs
+    build_cache = BuildCache(os.path.join(args.output_dir, '.build_cache'), force=args.force)
+
+    # completed (stage, region) pairs; a non-resumed run redoes its selected stages from scratch
+    setup_dir(args.output_dir)
+    state = PipelineState(os.path.join(args.output_dir, 'pipeline_state.json'))
+    if not args.resume:
+        state.reset(stages)
+
+    def pending(stage, region_ids):
+        todo = state.pending(stage, region_ids)
+        if len(todo) < len(region_ids):
+            print(f'Stage {stage}: resuming, {len(region_ids) - len(todo)}/{len(region_ids)} regions already done')
+        return todo
+
+    def mark_done(stage):
+        return lambda region_id: state.mark_done(stage, region_id)
+
     raw_dump_dir = os.path.join(args.output_dir, 'dump_raw')
-    setup_dir(raw_dump_dir)
-    process_subregions(args.data_json_path, args.region_vector_dir, raw_dump_dir)
-    
     aggregated_dump_dir = os.path.join(args.output_dir, 'dump_aggregated')
-    setup_dir(aggregated_dump_dir)
-    aggregate_slope_units(raw_dump_dir, aggregated_dump_dir)
-
     output_dir = os.path.join(args.output_dir, 'output')
-    setup_dir(output_dir)
-    process_slopeunits(aggregated_dump_dir, output_dir, min_slu_count=args.min_slu_count, data_json_path=args.data_json_path)
 
-    # clean up
-    if args.clean_dumps:
-        clean_dir(raw_dump_dir)
-        clean_dir(aggregated_dump_dir)
+    # regions whose stage 1 failed in this run; their partial raw dumps are left out of stages 2-3
+    failed = set()
+    if 1 in stages:
+        # GRASS is only started here, so runs of stages 2-3 never need a GRASS installation
+        from grass_region_processor import process_subregions
+        setup_dir(raw_dump_dir)
+        regions = pending(1, get_region_files(args.region_vector_dir))
+        with profiling.step('stage1'):
+            failed = set(process_subregions(args.data_json_path, args.region_vector_dir, raw_dump_dir, workers=args.workers, build_cache=build_cache,
+                use_resample_cache=not args.no_resample_cache, feature_backend=args.feature_backend,
+                regions=regions, on_region_done=mark_done(1), tile_pixel_budget=args.tile_pixel_budget, tile_halo=args.tile_halo,
+                tile_workers=args.tile_workers, inventory_fraction_supersample=args.inventory_fraction_supersample))
+        if failed:
+            print(f'Stage 1 failed for {len(failed)} regions, leaving them out of stages 2-3: ', sorted(failed))
+
+    if 2 in stages:
+        setup_dir(aggregated_dump_dir)
+        regions = pending(2, [region for region in list_region_dirs(raw_dump_dir) if region not in failed])
+        with profiling.step('stage2'):
+            aggregate_slope_units(raw_dump_dir, aggregated_dump_dir, data_json_path=args.data_json_path,
+                streaming=args.streaming, window_pixels=args.window_pixels, build_cache=build_cache,
+                regions=regions, on_region_done=mark_done(2), prefetch=args.prefetch)
+
+    if 3 in stages:
+        setup_dir(output_dir)
+        regions = pending(3, [region for region in list_region_stores(aggregated_dump_dir) if region not in failed])
+        with profiling.step('stage3'):
+            process_slopeunits(aggregated_dump_dir, output_dir, min_slu_count=args.min_slu_count, data_json_path=args.data_json_path,
+                zonal_engine=args.zonal_engine, build_cache=build_cache, regions=regions, on_region_done=mark_done(3),
+                prefetch=args.prefetch)
+
+        if args.dataset_dir is not None:
+            with profiling.step('export_dataset'):
+                export_dataset(output_dir, args.dataset_dir)
+
+        # clean up
+        if args.clean_dumps:
+            clean_dir(raw_dump_dir)
+            clean_dir(aggregated_dump_dir)
+
+    if not args.no_trace:
+        profiling.write_report(trace_dir)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,54 @@
+import json
+import os
+import time
+
+STAGES = (1, 2, 3)
+
+class PipelineState:
+    """
+    Ledger of completed (stage, region) pairs, persisted after every region so
+    a crashed run can be resumed without redoing finished regions.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.completed = json.load(f)['completed']
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'completed': self.completed}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, stage, region_id):
+        return region_id in self.completed.get(str(stage), {})
+
+    def mark_done(self, stage, region_id):
+        self.completed.setdefault(str(stage), {})[region_id] = time.time()
+        # the region's later stages were built from the outputs that were just replaced
+        for later in STAGES:
+            if later > stage:
+                self.completed.get(str(later), {}).pop(region_id, None)
+        self._save()
+
+    def pending(self, stage, region_ids):
+        return [region_id for region_id in region_ids if not self.is_done(stage, region_id)]
+
+    def reset(self, stages):
+        """Forget the completed regions of the given stages (a fresh, non-resumed run of them)."""
+        for stage in stages:
+            self.completed.pop(str(stage), None)
+        self._save()
+
+def select_stages(stages=None, from_stage=None):
+    """Stages to run, in order, from an explicit list and/or a starting stage."""
+    selected = list(STAGES) if stages is None else sorted(set(stages))
+    if from_stage is not None:
+        selected = [stage for stage in selected if stage >= from_stage]
+    unknown = set(selected) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages {sorted(unknown)}, expected a subset of {STAGES}")
+    return selected
@@ -0,0 +1,161 @@
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+import pandas as pd
+
+# trace records are appended here (one JSON line per step); inherited by worker processes
+TRACE_DIR_ENV = 'SLU_TRACE_DIR'
+
+# region tag of the steps recorded by each thread (see region())
+_local = threading.local()
+
+def enable(trace_dir):
+    """Start recording steps of this process and of any worker it spawns to trace_dir."""
+    os.makedirs(trace_dir, exist_ok=True)
+    os.environ[TRACE_DIR_ENV] = trace_dir
+
+def _maxrss_bytes(maxrss):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def _cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def _record(entry):
+    trace_dir = os.environ.get(TRACE_DIR_ENV)
+    if trace_dir is None:
+        return
+    entry['region'] = getattr(_local, 'region', None)
+    entry['pid'] = os.getpid()
+    with open(os.path.join(trace_dir, f'trace_{os.getpid()}.jsonl'), 'a') as f:
+        f.write(json.dumps(entry, default=str) + '\n')
+
+def _loggable_params(args, kwargs):
+    params = {f'arg{i}': arg for i, arg in enumerate(args) if isinstance(arg, (str, int, float, bool))}
+    params.update({key: value for key, value in kwargs.items() if isinstance(value, (str, int, float, bool, list, tuple))})
+    return params
+
+@contextlib.contextmanager
+def region(region_id):
+    """Tag every step recorded inside the block, by the current thread, with region_id."""
+    previous, _local.region = getattr(_local, 'region', None), region_id
+    try:
+        yield
+    finally:
+        _local.region = previous
+
+def _cpu_scopes():
+    """
+    rusage scopes a step's CPU time is taken from: in the main thread the whole
+    process plus reaped children (GRASS modules, pool workers); in background
+    threads (e.g. region_pipeline loaders and writers) only the thread itself
+    where the platform supports it (Linux), else the whole process.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN
+    return getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF), None
+
+def _scope_cpu_seconds(scope):
+    return _cpu_seconds(resource.getrusage(scope)) if scope is not None else 0.0
+
+@contextlib.contextmanager
+def step(name, kind='stage', **params):
+    """
+    Record wall time, CPU time and peak RSS of a block. CPU time covers the
+    scopes of _cpu_scopes, so main-thread steps also count any background
+    threads running at the same time.
+    """
+    self_scope, children_scope = _cpu_scopes()
+    cpu_before = _scope_cpu_seconds(self_scope) + _scope_cpu_seconds(children_scope)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        cpu_after = _scope_cpu_seconds(self_scope) + _scope_cpu_seconds(children_scope)
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _record({
+            'name': name,
+            'kind': kind,
+            'params': params,
+            'start': time.time() - wall,
+            'wall_s': wall,
+            'cpu_s': cpu_after - cpu_before,
+            'peak_rss_bytes': _maxrss_bytes(max(self_after.ru_maxrss, children_after.ru_maxrss)),
+        })
+
+def profiled(fn):
+    """Decorator recording every call of a stage function as a step."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with step(fn.__name__, kind='function', **_loggable_params(args, kwargs)):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def run_command(module, **params):
+    """
+    Drop-in for grass.script.run_command that records the module's own wall
+    time, CPU time and peak RSS (from the child's rusage via wait4).
+    """
+    import grass.script as gs
+    from grass.script.core import handle_errors
+    start = time.perf_counter()
+    process = gs.start_command(module, **params)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu, peak_rss = _cpu_seconds(usage), _maxrss_bytes(usage.ru_maxrss)
+    else:
+        process.wait()
+        cpu, peak_rss = None, None
+    wall = time.perf_counter() - start
+    _record({
+        'name': module,
+        'kind': 'grass',
+        'params': params,
+        'start': time.time() - wall,
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'peak_rss_bytes': peak_rss,
+    })
+    return handle_errors(process.returncode, process.returncode, [module], params)
+
+def load_trace(trace_dir):
+    """All steps recorded under trace_dir (from every process) as a DataFrame."""
+    records = []
+    for filename in sorted(os.listdir(trace_dir)):
+        if filename.startswith('trace_') and filename.endswith('.jsonl'):
+            with open(os.path.join(trace_dir, filename), 'r') as f:
+                records += [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(records, columns=['name', 'kind', 'region', 'pid', 'params', 'start', 'wall_s', 'cpu_s', 'peak_rss_bytes'])
+
+def summarize(trace):
+    """Hottest steps first: call count, total/mean/max wall time, total CPU time and peak RSS per step name."""
+    summary = trace.groupby(['kind', 'name']).agg(
+        calls=('wall_s', 'size'),
+        total_wall_s=('wall_s', 'sum'),
+        mean_wall_s=('wall_s', 'mean'),
+        max_wall_s=('wall_s', 'max'),
+        total_cpu_s=('cpu_s', 'sum'),
+        peak_rss_mb=('peak_rss_bytes', lambda x: x.max() / 2 ** 20),
+    )
+    return summary.sort_values('total_wall_s', ascending=False)
+
+def write_report(trace_dir):
+    """Write trace.json, trace.csv and summary.csv to trace_dir and print the summary table."""
+    trace = load_trace(trace_dir)
+    if trace.empty:
+        return trace
+    trace.sort_values('start').to_json(os.path.join(trace_dir, 'trace.json'), orient='records', indent=1)
+    trace.assign(params=trace['params'].map(json.dumps)).sort_values('start').to_csv(os.path.join(trace_dir, 'trace.csv'), index=False)
+    summary = summarize(trace)
+    summary.to_csv(os.path.join(trace_dir, 'summary.csv'))
+    print(summary.head(20).to_string())
+    return summary
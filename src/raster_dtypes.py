@@ -0,0 +1,108 @@
+import numpy as np
+import rasterio
+
+# narrowest-first candidates; label 0 is reserved for pixels outside every slope unit
+LABEL_DTYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+# narrowest-first candidates for categorical bands, each with the sentinel it reserves for nodata
+CATEGORICAL_DTYPES = ((np.uint8, 255), (np.int16, -32768), (np.int32, -2147483648))
+
+def label_dtype(max_label):
+    """Narrowest unsigned integer dtype holding slope-unit IDs up to max_label."""
+    for dtype in LABEL_DTYPES:
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"Slope-unit ID {max_label} does not fit in 64 bits")
+
+def categorical_dtype(lo, hi):
+    """
+    Narrowest integer dtype holding category codes lo..hi next to its nodata
+    sentinel, as (dtype, nodata), or (None, None) if none does.
+    """
+    for dtype, nodata in CATEGORICAL_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max and not lo <= nodata <= hi:
+            return np.dtype(dtype), nodata
+    return None, None
+
+def nodata_mask(raster, nodata):
+    """Boolean mask of nodata pixels; nodata may be NaN. None if nodata is None."""
+    if nodata is None:
+        return None
+    if np.isnan(nodata):
+        return np.isnan(raster) if raster.dtype.kind == 'f' else np.zeros(raster.shape, dtype=bool)
+    return raster == nodata
+
+def to_labels(raw, src_nodata, dtype):
+    """Cast a slope-unit window to dtype, with the GeoTIFF's nodata pixels set to 0."""
+    invalid = nodata_mask(raw, src_nodata)
+    labels = raw.astype(dtype, copy=False)
+    if invalid is not None:
+        if labels is raw:
+            labels = labels.copy()
+        labels[invalid] = 0
+    return labels
+
+def read_labels(path):
+    """Slope-unit raster in the narrowest unsigned integer dtype, nodata as 0."""
+    with rasterio.open(path) as src:
+        raw = src.read(1)
+        src_nodata = src.nodata
+    invalid = nodata_mask(raw, src_nodata)
+    max_label = raw[~invalid].max(initial=0) if invalid is not None else raw.max(initial=0)
+    return to_labels(raw, src_nodata, label_dtype(int(max_label)))
+
+def read_continuous_window(src, window=None):
+    """Band 1 of an open dataset (or one window of it) as float32 with nodata as NaN."""
+    raster = src.read(1, window=window, out_dtype=np.float32)
+    if src.nodata is not None and not np.isnan(src.nodata):
+        raster[raster == np.float32(src.nodata)] = np.nan
+    return raster
+
+def read_continuous(path, window=None):
+    """Continuous band as float32 with nodata as NaN."""
+    with rasterio.open(path) as src:
+        return read_continuous_window(src, window=window)
+
+def read_categorical(path):
+    """
+    Categorical band as (array, nodata) in the narrowest integer dtype that
+    holds its codes, falling back to float32/NaN for non-integral codes.
+    """
+    raster = read_continuous(path)
+    valid = ~np.isnan(raster)
+    codes = raster[valid]
+    if len(codes) == 0 or np.any(codes != np.round(codes)):
+        return raster, np.nan
+    dtype, nodata = categorical_dtype(int(codes.min()), int(codes.max()))
+    if dtype is None:
+        return raster, np.nan
+    del codes
+    compact = np.full(raster.shape, nodata, dtype=dtype)
+    compact[valid] = raster[valid]
+    return compact, nodata
+
+def inventory_mask(raw, src_nodata):
+    """
+    Landslide pixels of an inventory window. Stage 1 crops with
+    if(x, x, null()), so both 0 and nodata mean "no landslide".
+    """
+    invalid = nodata_mask(raw, src_nodata)
+    landslide = raw != 0
+    if raw.dtype.kind == 'f':
+        landslide &= ~np.isnan(raw)
+    if invalid is not None:
+        landslide &= ~invalid
+    return landslide
+
+def read_inventory(path):
+    """Inventory raster as a boolean landslide mask."""
+    with rasterio.open(path) as src:
+        return inventory_mask(src.read(1), src.nodata)
+
+def pack_mask(mask):
+    """Pack a 2D boolean mask to 1 bit per pixel along rows."""
+    return np.packbits(mask, axis=1)
+
+def unpack_rows(packed, width, start, stop):
+    """Rows start..stop of a mask packed by pack_mask, as uint8 0/1."""
+    return np.unpackbits(packed[start:stop], axis=1, count=width)
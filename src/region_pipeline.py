@@ -0,0 +1,69 @@
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
+
+# regions loaded ahead of the one being computed, and region writes in flight
+DEFAULT_PREFETCH = 2
+DEFAULT_PENDING_WRITES = 2
+
+def _tagged(step_name, phase, fn, item, *args):
+    with profiling.region(item), profiling.step(step_name, kind='function', phase=phase):
+        return fn(item, *args)
+
+def run_pipelined(items, load, compute, write, prefetch=DEFAULT_PREFETCH, pending_writes=DEFAULT_PENDING_WRITES, on_done=None,
+        step_name='region'):
+    """
+    Run load(item) -> compute(item, loaded) -> write(item, result) over items
+    with I/O overlapped with compute. Background threads load up to prefetch
+    items ahead while the calling thread computes the current one, and write
+    finished results with at most pending_writes writes in flight, so at most
+    prefetch + pending_writes + 1 items are held in memory. rasterio/GDAL and
+    numpy file I/O release the GIL, so reads and writes of neighbouring items
+    run while the current one is computed.
+
+    on_done(item) is called from the calling thread, in item order, once the
+    item is written. Every phase is recorded as a profiling step step_name
+    with a phase parameter (load, compute or write), tagged with its item.
+    If a step fails, the writes already in flight are still completed (and
+    reported to on_done) before that error is raised; errors of those writes
+    are logged rather than raised in its place.
+    """
+    items = list(items)
+    loads, writes = deque(), deque()
+
+    def finish_write():
+        item, future = writes.popleft()
+        future.result()
+        if on_done is not None:
+            on_done(item)
+
+    with ThreadPoolExecutor(max_workers=max(1, prefetch), thread_name_prefix='load') as loader, \
+            ThreadPoolExecutor(max_workers=max(1, pending_writes), thread_name_prefix='write') as writer:
+        try:
+            for position, item in enumerate(items):
+                while len(loads) <= prefetch and position + len(loads) < len(items):
+                    ahead = items[position + len(loads)]
+                    loads.append(loader.submit(_tagged, step_name, 'load', load, ahead))
+                loaded = loads.popleft().result()
+                result = _tagged(step_name, 'compute', compute, item, loaded)
+                del loaded
+                while len(writes) >= max(1, pending_writes):
+                    finish_write()
+                writes.append((item, writer.submit(_tagged, step_name, 'write', write, item, result)))
+                del result
+        except BaseException:
+            for future in loads:
+                future.cancel()
+            while writes:
+                item, future = writes.popleft()
+                try:
+                    future.result()
+                    if on_done is not None:
+                        on_done(item)
+                except Exception:
+                    logging.exception(f"Write of {item} failed while handling an earlier error")
+            raise
+        while writes:
+            finish_write()
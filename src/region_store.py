@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+import json
+import os
+import shutil
+from affine import Affine
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+
+METADATA_FILE = 'metadata.json'
+
+def _encode_metadata(metadata):
+    encoded = {}
+    for key, value in metadata.items():
+        if isinstance(value, CRS):
+            value = {'__crs__': value.to_wkt()}
+        elif isinstance(value, Affine):
+            value = {'__affine__': list(value)[:6]}
+        elif isinstance(value, BoundingBox):
+            value = {'__bounds__': list(value)}
+        elif isinstance(value, np.generic):
+            value = value.item()
+        elif isinstance(value, tuple):
+            value = list(value)
+        elif isinstance(value, dict):
+            value = _encode_metadata(value)
+        encoded[key] = value
+    return encoded
+
+def _decode_metadata(metadata):
+    decoded = {}
+    for key, value in metadata.items():
+        if isinstance(value, dict):
+            if '__crs__' in value:
+                value = CRS.from_wkt(value['__crs__']) if value['__crs__'] else None
+            elif '__affine__' in value:
+                value = Affine(*value['__affine__'])
+            elif '__bounds__' in value:
+                value = BoundingBox(*value['__bounds__'])
+            else:
+                value = _decode_metadata(value)
+        decoded[key] = value
+    return decoded
+
+class RegionStore:
+    """
+    On-disk store for one region: every array is its own .npy file that can be
+    opened with mmap_mode, per-slope-unit tables are Parquet files readable
+    column by column, and a small JSON sidecar holds the metadata.
+
+    Layout::
+
+        <path>/metadata.json
+        <path>/arrays/<name>.npy      (name may contain '/', e.g. features/slope)
+        <path>/tables/<name>.parquet
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def create(cls, path):
+        """Create (or reset) a store directory."""
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(os.path.join(path, 'arrays'))
+        os.makedirs(os.path.join(path, 'tables'))
+        store = cls(path)
+        store.write_metadata({})
+        return store
+
+    def _array_path(self, name):
+        return os.path.join(self.path, 'arrays', f'{name}.npy')
+
+    def _table_path(self, name):
+        return os.path.join(self.path, 'tables', f'{name}.parquet')
+
+    # metadata
+    def read_metadata(self):
+        with open(os.path.join(self.path, METADATA_FILE), 'r') as f:
+            return _decode_metadata(json.load(f))
+
+    def write_metadata(self, metadata):
+        with open(os.path.join(self.path, METADATA_FILE), 'w') as f:
+            json.dump(_encode_metadata(metadata), f, indent=2)
+
+    def update_metadata(self, **kwargs):
+        metadata = self.read_metadata()
+        metadata.update(kwargs)
+        self.write_metadata(metadata)
+
+    # arrays
+    def has_array(self, name):
+        return os.path.exists(self._array_path(name))
+
+    def write_array(self, name, array):
+        path = self._array_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, np.asarray(array))
+
+    def create_array(self, name, shape, dtype):
+        """Allocate a writable memory-mapped .npy array, for filling window by window."""
+        path = self._array_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    def read_array(self, name, mmap_mode='r'):
+        """Open an array; with the default mmap_mode nothing is read until it is touched."""
+        return np.load(self._array_path(name), mmap_mode=mmap_mode)
+
+    def link_array(self, name, source_store, source_name=None):
+        """Expose another store's array under name without copying it when the filesystem allows."""
+        src = source_store._array_path(name if source_name is None else source_name)
+        dst = self._array_path(name)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.exists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    # tables
+    def has_table(self, name):
+        return os.path.exists(self._table_path(name))
+
+    def write_table(self, name, df):
+        df.to_parquet(self._table_path(name), index=False)
+
+    def read_table(self, name, columns=None):
+        """Read a per-slope-unit table, optionally only the listed columns."""
+        return pd.read_parquet(self._table_path(name), columns=columns)
+
+def is_region_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, METADATA_FILE))
+
+def list_region_stores(base_dir):
+    """Region IDs of all stores directly under base_dir."""
+    return sorted(
+        region for region in os.listdir(base_dir)
+        if region[0] != '.' and is_region_store(os.path.join(base_dir, region))
+    )
+
+def load_region_output(path, columns=None, mmap_mode='r'):
+    """
+    Open a stage-3 region output for training. Only the requested feature
+    columns are read from the Parquet table; arrays are memory-mapped.
+
+    Returns:
+        dict: same keys as the former per-region pickle ('X', 'y', 'counts',
+              'kept_su_ids', 'slope_units', 'metadata', 'centroids'), plus
+              'y_fraction' (landslide area fraction per unit) when stage 1
+              exported the inventory fraction.
+    """
+    store = RegionStore(path)
+    output = {
+        'X': store.read_table('X', columns=columns),
+        'y': store.read_array('y', mmap_mode=mmap_mode),
+        'counts': store.read_array('counts', mmap_mode=mmap_mode),
+        'kept_su_ids': store.read_array('kept_su_ids', mmap_mode=mmap_mode),
+        'slope_units': store.read_array('slope_units', mmap_mode=mmap_mode),
+        'metadata': store.read_metadata(),
+        'centroids': store.read_array('centroids', mmap_mode=mmap_mode),
+    }
+    if store.has_array('y_fraction'):
+        output['y_fraction'] = store.read_array('y_fraction', mmap_mode=mmap_mode)
+    return output
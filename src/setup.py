@@ -2,6 +2,7 @@ import os
 import sys
 import logging
 import configparser
+import shutil
 
 class ConfigManager:
     def __init__(self, config_file = './slopeunits.ini'):
@@ -25,23 +26,55 @@ class ConfigManager:
         os.environ['LD_LIBRARY_PATH'] = os.path.join(GISBASE, 'lib')
         os.environ['PYTHONPATH'] = os.path.join(GISBASE, 'etc', 'python')
 
-        sys.path.append('/Applications/GRASS-7.8.app/Contents/Resources/etc/python')
+        sys.path.append(os.path.join(GISBASE, 'etc', 'python'))
 
         import grass.script.setup as gsetup
         gsetup.init(GISBASE, GISDB, LOCATION, MAPSET)
 
+    def _location_path(self):
+        return os.path.join(self.config['GISDB'], self.config['LOCATION'])
+
+    def use_temp_mapset(self, mapset):
+        '''
+        Create an empty mapset under the configured GISDB/LOCATION and switch this
+        process's GRASS session to it. Region and mask changes then stay private
+        to the mapset, while maps imported into PERMANENT (and the configured
+        MAPSET) remain readable through the mapset search path.
+        '''
+        mapset_path = os.path.join(self._location_path(), mapset)
+        os.makedirs(mapset_path, exist_ok=True)
+        shutil.copy(os.path.join(self._location_path(), 'PERMANENT', 'DEFAULT_WIND'), os.path.join(mapset_path, 'WIND'))
+
+        import grass.script.setup as gsetup
+        import grass.script as gs
+        gsetup.init(self.config['GISBASE'], self.config['GISDB'], self.config['LOCATION'], mapset)
+        shared_mapsets = ['PERMANENT'] + ([self.config['MAPSET']] if self.config['MAPSET'] != 'PERMANENT' else [])
+        gs.run_command('g.mapsets', mapset=','.join(shared_mapsets), operation='add')
+        logging.info(f"Using temporary mapset {mapset} (pid {os.getpid()})")
+
+    def remove_temp_mapsets(self, prefix):
+        '''Delete all mapsets under the configured location whose name starts with prefix.'''
+        location_path = self._location_path()
+        for mapset in os.listdir(location_path):
+            if mapset.startswith(prefix) and mapset not in ('PERMANENT', self.config['MAPSET']):
+                shutil.rmtree(os.path.join(location_path, mapset), ignore_errors=True)
+
     def _setup_logging(self):
-        log_filename = os.path.join('/Users/arushramteke/Projects/Landslide/logs', self.config['LOGFILE'])
+        log_dir = self.config.get('LOGDIR', 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+        log_filename = os.path.join(log_dir, self.config['LOGFILE'])
         logger = logging.getLogger()
         logger.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(process)d - %(message)s')
 
         # Create a file handler for file output
         file_handler = logging.FileHandler(log_filename)
         file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
 
         console_handler = logging.StreamHandler()
         console_handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         console_handler.setFormatter(formatter)
         logger.addHandler(console_handler)
 
@@ -56,4 +89,14 @@ def get_region_files(region_dir):
             unique_files.add(base_name)
     return [file for file in unique_files if file[0] != '.']
 
-config_manager = ConfigManager()
\ No newline at end of file
+_config_manager = None
+
+def get_config_manager():
+    '''
+    The process-wide ConfigManager, created (and the GRASS session started) on
+    first use, so entry points that never touch GRASS do not pay for it.
+    '''
+    global _config_manager
+    if _config_manager is None:
+        _config_manager = ConfigManager()
+    return _config_manager
\ No newline at end of file
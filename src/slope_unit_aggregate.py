@@ -3,7 +3,19 @@ import pandas as pd
 import os
 import rasterio
 import argparse
-import pickle
+import json
+from rasterio.windows import Window
+
+import zonal_stats as zonal_stats_module
+from zonal_stats import count_units, ZonalAccumulator
+import raster_dtypes
+from region_store import RegionStore
+from region_pipeline import run_pipelined, DEFAULT_PENDING_WRITES
+import build_cache as bc
+import profiling
+
+# default number of pixels read per window in streaming mode
+DEFAULT_WINDOW_PIXELS = 1 << 24
 
 feature_filenames = [
     'aspect', 'curv_mean', 'curv_planform', 'curv_total', 'curv_profile', 'distance_to_active_fault', 'distance_to_channel', 'elevation', 'MAP', 'nee', 'PGA', 'relief', 'slope', 'soil_moisture_day_before', 'silt', 'clay', 'sand'
@@ -16,98 +28,408 @@ def load_tif_numpy(filepath, crop_edgecols=False):
         arr = arr[:,1:-1]
     return arr
 
-def stack_tif_files(base_dir):
+def list_feature_files(base_dir):
+    """
+    List the feature GeoTIFFs of a region directory, skipping the inventory
+    (and its area fraction) and slope-unit rasters.
+
+    Returns:
+        list of (str, str): (feature name, file path) pairs sorted by file name.
+    """
+    features = []
+    for local_path in sorted(os.listdir(base_dir)):
+        filename, ext = os.path.splitext(local_path)
+        if ext != '.tif' or filename in ('inventory', 'inventory_fraction', 'slopeunits'):
+            continue
+        features.append((filename, os.path.join(base_dir, local_path)))
+    return features
+
+def iter_windows(src, window_pixels=DEFAULT_WINDOW_PIXELS):
+    """
+    Yield full-width row windows of a rasterio dataset holding at most
+    window_pixels pixels each (but at least one row), aligned to the dataset's
+    block height when a window spans at least one block.
+    """
+    block_height = src.block_shapes[0][0]
+    rows = max(1, window_pixels // src.width)
+    if rows >= block_height:
+        rows -= rows % block_height
+    for row_off in range(0, src.height, rows):
+        yield Window(0, row_off, src.width, min(rows, src.height - row_off))
+
+def load_feature(file_path, categorical=False):
+    """
+    Load one feature band compactly: categorical bands in the narrowest integer
+    dtype holding their codes, continuous bands as float32.
+
+    Returns:
+        (numpy.ndarray, number): the band and its nodata value (NaN for floats).
+    """
+    if categorical:
+        return raster_dtypes.read_categorical(file_path)
+    return raster_dtypes.read_continuous(file_path), np.nan
+
+@profiling.profiled
+def stack_tif_files(base_dir, categorical_feature_names=None):
     """
     Stack multiple .tif raster files into a single 3D numpy array.
 
     Args:
-        file_paths (list of str): List of file paths to the .tif files.
+        base_dir (str): Region directory holding the feature .tif files.
+        categorical_feature_names (list of str): Features loaded as integer codes.
 
     Returns:
         numpy.ndarray: A 3D numpy array where each slice along the first dimension 
-                       corresponds to one .tif file.
+                       corresponds to one .tif file, in the narrowest dtype
+                       common to all bands (float32 as soon as one band is
+                       continuous).
     """
+    categorical_feature_names = [] if categorical_feature_names is None else categorical_feature_names
     # Initialize a list to hold the arrays
     arrays = []
     filenames = []
-    for local_path in os.listdir(base_dir):
-        file_path = os.path.join(base_dir, local_path)
-        filename, ext = os.path.splitext(local_path)
-        if ext != '.tif' or filename == 'inventory' or filename == 'slopeunits':
-            continue
+    for filename, file_path in list_feature_files(base_dir):
         filenames.append(filename)
-        arrays.append(load_tif_numpy(file_path).astype(np.float32))
+        arrays.append(load_feature(file_path, filename in categorical_feature_names)[0])
     # Stack all arrays along a new first dimension
     stacked_array = np.stack(arrays, axis=0)
     print(filenames)
     return stacked_array, filenames
 
+@profiling.profiled
 def compute_slopeunit_centroids(raster_path):
     """
     Reads a slope-units raster from 'raster_path', where each slope unit
-    is identified by a unique integer ID. Computes the centroid
-    (x, y) in map coordinates for each ID.
-    
+    is identified by a unique integer ID. Computes the pixel count and the
+    centroid (x, y) in map coordinates of every unit in a single pass.
+
     Returns
     -------
-    centroids : dict
-        Dictionary keyed by slope-unit ID, with values = (x, y) centroid.
+    slope_units : numpy.ndarray
+        The slope-unit raster in the narrowest unsigned integer dtype, with
+        the GeoTIFF's nodata pixels set to 0.
+    centroids : numpy.ndarray
+        Array of shape (n_units, 2); row i holds the (x, y) centroid of unit
+        i+1, or (0, 0) if the unit has no pixels.
+    counts : numpy.ndarray
+        Array of length n_units; entry i is the pixel count of unit i+1.
     """
+    slope_units = raster_dtypes.read_labels(raster_path)
     with rasterio.open(raster_path) as src:
-        slope_units = src.read(1)  # read the first (and only) band
         transform = src.transform
-        # If needed, check src.crs for the coordinate system
 
     print(slope_units.shape)
+    return (slope_units, *slopeunit_centroids(slope_units, transform))
 
-    unique_ids = np.unique(slope_units)
-    centroids = np.zeros((len(unique_ids), 2), dtype=np.float64)
-    for i, uid in enumerate(unique_ids):
-        if np.any(slope_units == uid) == 0:
-            continue
-        # Get all pixels belonging to this slope unit
-        rows, cols = np.where(slope_units == uid)
-        if len(rows) == 0:
-            continue  # skip if empty for some reason
-        # Compute the mean row and column
-        mean_row = rows.mean()
-        mean_col = cols.mean()
-        # Convert (row,col) → (x,y) using the geotransform
-        # You can do this manually or use rasterio's transform machinery:
-        # x, y = transform * (col, row)
-        x, y = rasterio.transform.xy(transform, mean_row, mean_col, offset='center')
-        centroids[i] = (x, y)
-    return slope_units, centroids
-
-def aggregate_slope_units(base_dir, output_dir):
-    for region in os.listdir(base_dir):
-        region_path = os.path.join(base_dir, region)
-        if region[0] == '.' or not os.path.isdir(region_path):  # Check if it's a directory
-            continue
-        region_data = {}
+def slopeunit_centroids(slope_units, transform):
+    """Centroids and pixel counts of an in-memory slope-unit raster, as in compute_slopeunit_centroids."""
+    n_units = count_units(slope_units)
+    counts, row_sums, col_sums = _pixel_sums(slope_units, n_units)
+    return _centroids_from_sums(counts, row_sums, col_sums, transform), counts
+
+def _pixel_sums(slope_units, n_units, row_offset=0):
+    """Per-unit pixel count and sums of row/col indices of a (windowed) label raster."""
+    labels = slope_units.ravel()
+    valid = np.flatnonzero((labels >= 1) & (labels <= n_units))
+    unit_idx = labels[valid].astype(np.int64) - 1
+    rows, cols = np.divmod(valid, slope_units.shape[1])
+    counts = np.bincount(unit_idx, minlength=n_units)
+    row_sums = np.bincount(unit_idx, weights=rows + row_offset, minlength=n_units)
+    col_sums = np.bincount(unit_idx, weights=cols, minlength=n_units)
+    return counts, row_sums, col_sums
+
+def _centroids_from_sums(counts, row_sums, col_sums, transform):
+    present = counts > 0
+    mean_row = row_sums[present] / counts[present]
+    mean_col = col_sums[present] / counts[present]
+    # (row, col) -> (x, y) at pixel centres, same as rasterio.transform.xy(offset='center')
+    centroids = np.zeros((len(counts), 2), dtype=np.float64)
+    centroids[present, 0] = transform.a * (mean_col + 0.5) + transform.b * (mean_row + 0.5) + transform.c
+    centroids[present, 1] = transform.d * (mean_col + 0.5) + transform.e * (mean_row + 0.5) + transform.f
+    return centroids
+
+@profiling.profiled
+def compute_slopeunit_centroids_windowed(raster_path, window_pixels=DEFAULT_WINDOW_PIXELS):
+    """
+    Windowed variant of compute_slopeunit_centroids that never holds the full
+    slope-unit raster in memory.
+
+    Returns
+    -------
+    n_units : int
+        Number of slope units (table length).
+    centroids, counts : numpy.ndarray
+        As in compute_slopeunit_centroids.
+    dtype : numpy.dtype
+        Narrowest unsigned integer dtype holding the labels.
+    """
+    with rasterio.open(raster_path) as src:
+        unique_ids = np.zeros(0, dtype=src.dtypes[0])
+        for window in iter_windows(src, window_pixels):
+            raw = src.read(1, window=window)
+            invalid = raster_dtypes.nodata_mask(raw, src.nodata)
+            unique_ids = np.union1d(unique_ids, np.unique(raw if invalid is None else np.where(invalid, 0, raw)))
+        n_units = len(unique_ids)
+        dtype = raster_dtypes.label_dtype(int(unique_ids.max(initial=0)))
+
+        counts = np.zeros(n_units, dtype=np.int64)
+        row_sums = np.zeros(n_units, dtype=np.float64)
+        col_sums = np.zeros(n_units, dtype=np.float64)
+        for window in iter_windows(src, window_pixels):
+            labels = raster_dtypes.to_labels(src.read(1, window=window), src.nodata, dtype)
+            window_sums = _pixel_sums(labels, n_units, row_offset=window.row_off)
+            counts += window_sums[0]
+            row_sums += window_sums[1]
+            col_sums += window_sums[2]
+        centroids = _centroids_from_sums(counts, row_sums, col_sums, src.transform)
+    return n_units, centroids, counts, dtype
+
+def read_region_metadata(region_path):
+    with rasterio.open(os.path.join(region_path, 'region.tif')) as src:
+        bounds = src.bounds
+        transform = src.transform
+        resolution = (transform.a, transform.e)
+        crs = src.crs
+    return {
+        'bounds': bounds,
+        'resolution': resolution,
+        'crs': crs,
+        'transform': transform,
+    }
+
+def read_inventory_fraction(path, window=None):
+    """Landslide area fraction band as float32, with nodata (no landslide after stage-1 cropping) as 0."""
+    with rasterio.open(path) as src:
+        return fraction_window(src, window=window)
+
+def fraction_window(src, window=None):
+    """read_inventory_fraction for one window of an already open area-fraction raster."""
+    return np.nan_to_num(raster_dtypes.read_continuous_window(src, window=window), nan=0.0)
+
+def read_region_rasters(region_path, categorical_feature_names=None, lazy_features=False):
+    """
+    Read the rasters of a region directory in compact dtypes (the I/O half of
+    aggregate_region): the inventory as a boolean landslide mask (and its area
+    fraction if stage 1 exported one), the slope units with their grid, and
+    (name, band, nodata) per feature. With
+    lazy_features, features are a generator loading one band at a time.
+    """
+    categorical_feature_names = [] if categorical_feature_names is None else categorical_feature_names
+    slopeunits_path = os.path.join(region_path, 'slopeunits.tif')
+    with rasterio.open(slopeunits_path) as src:
+        transform = src.transform
+    features = (
+        (name, *load_feature(path, name in categorical_feature_names))
+        for name, path in list_feature_files(region_path)
+    )
+    fraction_path = os.path.join(region_path, 'inventory_fraction.tif')
+    return {
+        'inventory': raster_dtypes.read_inventory(os.path.join(region_path, 'inventory.tif')),
+        'inventory_fraction': read_inventory_fraction(fraction_path) if os.path.exists(fraction_path) else None,
+        'slope_units': raster_dtypes.read_labels(slopeunits_path),
+        'transform': transform,
+        'features': features if lazy_features else list(features),
+        'metadata': read_region_metadata(region_path),
+    }
+
+@profiling.profiled
+def summarize_region_rasters(rasters):
+    """The compute half of aggregate_region: pack the inventory and compute slope-unit centroids and counts."""
+    centroids, counts = slopeunit_centroids(rasters['slope_units'], rasters['transform'])
+    return {
+        **rasters,
+        'inventory': raster_dtypes.pack_mask(rasters['inventory']),
+        'centroids': centroids,
+        'counts': counts,
+    }
+
+def write_region_store(store, summary):
+    """Write a summarized region to its RegionStore, one band at a time; per-feature nodata values go to the metadata."""
+    store.write_array('inventory', summary['inventory'])
+    if summary['inventory_fraction'] is not None:
+        store.write_array('inventory_fraction', summary['inventory_fraction'])
+    store.write_array('slopeunits', summary['slope_units'])
+    store.write_array('centroids', summary['centroids'])
+    store.write_array('counts', summary['counts'])
 
-        region_data['inventory'] = load_tif_numpy(os.path.join(region_path, 'inventory.tif'))
-        region_data['slopeunits'], region_data['centroids'] = compute_slopeunit_centroids(os.path.join(region_path, 'slopeunits.tif'))
-        region_data['features'], region_data['names'] = stack_tif_files(region_path)
+    names, nodata = [], {}
+    for name, band, band_nodata in summary['features']:
+        names.append(name)
+        nodata[name] = band_nodata
+        store.write_array(f'features/{name}', band)
+        del band
+    print(names)
 
-        with rasterio.open(os.path.join(region_path, 'region.tif')) as src:
-            bounds = src.bounds
-            transform = src.transform
-            resolution = (transform.a, transform.e)
-            crs = src.crs
+    store.write_metadata({
+        **summary['metadata'],
+        'aggregation': 'raster',
+        'names': names,
+        'nodata': nodata,
+        'n_units': len(summary['counts']),
+    })
 
-        region_data['metadata'] = {
-            'bounds': bounds,
-            'resolution': resolution,
-            'crs': crs
-        }
+@profiling.profiled
+def aggregate_region(region_path, store, categorical_feature_names=None):
+    """
+    Copy a region's rasters into its RegionStore one band at a time, each in a
+    compact dtype: the inventory as a bit-packed landslide mask, the slope-unit
+    raster in the narrowest unsigned type with its centroids and counts, and
+    one array per feature under features/<name> (integer codes for categorical
+    features, float32 otherwise). Per-feature nodata values go to the metadata.
+    """
+    rasters = read_region_rasters(region_path, categorical_feature_names, lazy_features=True)
+    write_region_store(store, summarize_region_rasters(rasters))
+
+@profiling.profiled
+def aggregate_region_streaming(region_path, store, categorical_feature_names=None, window_pixels=DEFAULT_WINDOW_PIXELS):
+    """
+    Compute the per-slope-unit statistics of every feature in a region by
+    streaming row windows of each feature GeoTIFF alongside the matching
+    slope-unit window. Peak memory is bounded by window_pixels rather than by
+    region size; nothing is stacked.
 
-        with open(os.path.join(output_dir, region) + '.pkl', 'wb') as f:
-            pickle.dump(region_data, f)
+    Continuous features accumulate count/mean/var/min/max, categorical features
+    a per-unit category histogram for the mode, and the inventory (and its
+    area fraction, if present) its mean.
+    The results go to the store's 'feature_stats' table as <feature>_<stat>
+    columns, and the slope-unit raster is copied window by window.
+    """
+    categorical_feature_names = [] if categorical_feature_names is None else categorical_feature_names
+    slopeunits_path = os.path.join(region_path, 'slopeunits.tif')
+    n_units, centroids, counts, label_dtype = compute_slopeunit_centroids_windowed(slopeunits_path, window_pixels)
+
+    features = list_feature_files(region_path)
+    names = [name for name, _ in features]
+    accumulators = {
+        name: ZonalAccumulator(n_units, stats=['mode'] if name in categorical_feature_names else ['mean', 'var', 'min', 'max'])
+        for name in names
+    }
+    inventory_accumulator = ZonalAccumulator(n_units, stats=['mean'])
+    fraction_path = os.path.join(region_path, 'inventory_fraction.tif')
+    fraction_accumulator = ZonalAccumulator(n_units, stats=['mean']) if os.path.exists(fraction_path) else None
+
+    sources = {name: rasterio.open(path) for name, path in features}
+    sources['inventory'] = rasterio.open(os.path.join(region_path, 'inventory.tif'))
+    if fraction_accumulator is not None:
+        sources['inventory_fraction'] = rasterio.open(fraction_path)
+    try:
+        with rasterio.open(slopeunits_path) as su_src:
+            slope_units = store.create_array('slopeunits', (su_src.height, su_src.width), label_dtype)
+            for window in iter_windows(su_src, window_pixels):
+                labels = raster_dtypes.to_labels(su_src.read(1, window=window), su_src.nodata, label_dtype)
+                slope_units[window.row_off:window.row_off + window.height] = labels
+                inventory = sources['inventory']
+                inventory_accumulator.update(raster_dtypes.inventory_mask(inventory.read(1, window=window), inventory.nodata), labels)
+                if fraction_accumulator is not None:
+                    fraction_accumulator.update(fraction_window(sources['inventory_fraction'], window=window), labels)
+                for name in names:
+                    # float32 with nodata as NaN, masked like read_region_rasters masks whole bands
+                    accumulators[name].update(raster_dtypes.read_continuous_window(sources[name], window=window), labels, nodata=np.nan)
+            slope_units.flush()
+            del slope_units
+    finally:
+        for src in sources.values():
+            src.close()
+    print(names)
+
+    feature_stats = {'inventory_mean': inventory_accumulator.result()['mean']}
+    if fraction_accumulator is not None:
+        feature_stats['inventory_fraction_mean'] = fraction_accumulator.result()['mean']
+    for name in names:
+        for stat, values in accumulators[name].result().items():
+            feature_stats[f'{name}_{stat}'] = values
+    store.write_table('feature_stats', pd.DataFrame(feature_stats))
+    store.write_array('centroids', centroids)
+    store.write_array('counts', counts)
+    store.write_metadata({
+        **read_region_metadata(region_path),
+        'aggregation': 'streaming',
+        'names': names,
+        'n_units': n_units,
+    })
+
+def list_region_dirs(base_dir):
+    """Region IDs of the stage-1 region directories under base_dir."""
+    return sorted(
+        region for region in os.listdir(base_dir)
+        if region[0] != '.' and os.path.isdir(os.path.join(base_dir, region))
+    )
+
+def aggregate_slope_units(base_dir, output_dir, data_json_path=None, streaming=False, window_pixels=DEFAULT_WINDOW_PIXELS, build_cache=None,
+        regions=None, on_region_done=None, prefetch=0, pending_writes=DEFAULT_PENDING_WRITES):
+    """
+    Stage 2: turn every region directory of GeoTIFFs under base_dir into a
+    RegionStore at output_dir/<region>. With a build_cache, regions whose raw
+    dump, options and code are unchanged since the last run are skipped.
+    regions restricts the run to a subset of region IDs; on_region_done(region)
+    is called after each region is written or skipped as unchanged.
+
+    With prefetch > 0 (raster mode only), regions run through
+    region_pipeline.run_pipelined: the next prefetch regions are read in
+    background threads while the current one is summarized, and stores are
+    written asynchronously, pending_writes at a time.
+    """
+    categorical_feature_names = []
+    if data_json_path is not None:
+        with open(data_json_path, 'r') as f:
+            categorical_feature_names = list(json.load(f)['categorical_features'].keys())
+
+    keys, pending = {}, []
+    for region in list_region_dirs(base_dir):
+        if regions is not None and region not in regions:
+            continue
+        if build_cache is not None:
+            keys[region] = build_cache.stage_key(
+                inputs=build_cache.hash_files([os.path.join(base_dir, region)]),
+                streaming=streaming,
+                categorical_feature_names=sorted(categorical_feature_names),
+                code=bc.code_version(__file__, raster_dtypes.__file__, zonal_stats_module.__file__),
+            )
+            if build_cache.is_fresh('stage2', region, keys[region]):
+                print('Skipping unchanged region: ', region)
+                if on_region_done is not None:
+                    on_region_done(region)
+                continue
+        pending.append(region)
+
+    def finish(region):
+        if build_cache is not None:
+            build_cache.record('stage2', region, keys[region], [os.path.join(output_dir, region)])
+        if on_region_done is not None:
+            on_region_done(region)
+
+    if prefetch > 0 and not streaming:
+        # streaming mode already bounds memory per window, so only whole-region reads are pipelined
+        run_pipelined(
+            pending,
+            load=lambda region: read_region_rasters(os.path.join(base_dir, region), categorical_feature_names),
+            compute=lambda region, rasters: summarize_region_rasters(rasters),
+            write=lambda region, summary: write_region_store(RegionStore.create(os.path.join(output_dir, region)), summary),
+            prefetch=prefetch,
+            pending_writes=pending_writes,
+            on_done=finish,
+            step_name='aggregate_region',
+        )
+        return
+
+    for region in pending:
+        region_path = os.path.join(base_dir, region)
+        store = RegionStore.create(os.path.join(output_dir, region))
+        with profiling.region(region):
+            if streaming:
+                aggregate_region_streaming(region_path, store, categorical_feature_names, window_pixels=window_pixels)
+            else:
+                aggregate_region(region_path, store, categorical_feature_names)
+        finish(region)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--base_dir', type=str, required=True)
     parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--data_json_path', type=str, default=None)
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--window_pixels', type=int, default=DEFAULT_WINDOW_PIXELS)
+    parser.add_argument('--prefetch', type=int, default=0, help='regions read ahead in background threads (0: sequential)')
     args = parser.parse_args()
-    aggregate_slope_units(args.base_dir, args.output_dir)
\ No newline at end of file
+    aggregate_slope_units(args.base_dir, args.output_dir, data_json_path=args.data_json_path,
+        streaming=args.streaming, window_pixels=args.window_pixels, prefetch=args.prefetch)
\ No newline at end of file
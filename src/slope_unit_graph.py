@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import scipy.sparse as sp
+
+from region_store import RegionStore, list_region_stores
+from zonal_stats import row_chunks
+import profiling
+
+ADJACENCY = 'adjacency'
+
+def _boundary_pairs(a, b, n_units, edge_length):
+    """Unit pairs (as keys lo * n_units + hi, 0-based) of differing neighbouring pixels, with their summed edge length."""
+    a, b = a.ravel(), b.ravel()
+    touching = (a != b) & (a >= 1) & (a <= n_units) & (b >= 1) & (b <= n_units)
+    a, b = a[touching].astype(np.int64) - 1, b[touching].astype(np.int64) - 1
+    keys, counts = np.unique(np.minimum(a, b) * n_units + np.maximum(a, b), return_counts=True)
+    return keys, counts * edge_length
+
+@profiling.profiled
+def build_adjacency(slope_units, n_units, resolution=(1.0, -1.0)):
+    """
+    Slope-unit adjacency graph from the label raster in one vectorized pass
+    over horizontally and vertically shifted pixel pairs (4-connectivity),
+    fed row chunk by row chunk.
+
+    Returns:
+        scipy.sparse.csr_matrix: symmetric (n_units, n_units) matrix where
+            entry (i, j) is the shared boundary length between units i+1 and
+            j+1 in map units (pixel edges times the pixel size).
+    """
+    height = slope_units.shape[0]
+    # a vertical pixel edge (between horizontal neighbours) is one pixel tall, and vice versa
+    dx, dy = abs(resolution[0]), abs(resolution[1])
+    keys, lengths = [], []
+    for start, stop in row_chunks(slope_units.shape):
+        block = slope_units[start:min(stop + 1, height)]
+        rows = block[:stop - start]
+        for pair in (_boundary_pairs(rows[:, :-1], rows[:, 1:], n_units, dy), _boundary_pairs(block[:-1], block[1:], n_units, dx)):
+            keys.append(pair[0])
+            lengths.append(pair[1])
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    lengths = np.bincount(inverse, weights=np.concatenate(lengths), minlength=len(keys))
+    lo, hi = np.divmod(keys, n_units)
+    adjacency = sp.coo_matrix((np.r_[lengths, lengths], (np.r_[lo, hi], np.r_[hi, lo])), shape=(n_units, n_units))
+    return adjacency.tocsr()
+
+def write_adjacency(store, adjacency):
+    """Save a CSR adjacency matrix as adjacency/{indptr,indices,data} arrays of a region store."""
+    store.write_array(f'{ADJACENCY}/indptr', adjacency.indptr)
+    store.write_array(f'{ADJACENCY}/indices', adjacency.indices)
+    store.write_array(f'{ADJACENCY}/data', adjacency.data)
+
+def read_adjacency(store):
+    indptr = store.read_array(f'{ADJACENCY}/indptr', mmap_mode=None)
+    n_units = len(indptr) - 1
+    return sp.csr_matrix((
+        store.read_array(f'{ADJACENCY}/data', mmap_mode=None),
+        store.read_array(f'{ADJACENCY}/indices', mmap_mode=None),
+        indptr,
+    ), shape=(n_units, n_units))
+
+def neighbour_means(adjacency, table, kept_su_ids):
+    """
+    Boundary-length weighted mean of each column over the kept neighbours of
+    every kept unit, as one sparse matrix product.
+
+    Args:
+        adjacency (scipy.sparse.csr_matrix): Graph over all units (from build_adjacency).
+        table (pandas.DataFrame): Per-unit columns, one row per kept unit.
+        kept_su_ids (numpy.ndarray): Slope-unit IDs of the table rows.
+
+    Returns:
+        pandas.DataFrame: <column>_nbr_mean columns; 0 for units without kept neighbours.
+    """
+    kept = np.asarray(kept_su_ids) - 1
+    weights = adjacency[kept][:, kept]
+    total = np.asarray(weights.sum(axis=1)).ravel()
+    sums = weights @ table.to_numpy(dtype=np.float64)
+    means = np.zeros_like(sums)
+    has_neighbours = total > 0
+    means[has_neighbours] = sums[has_neighbours] / total[has_neighbours, None]
+    return pd.DataFrame(means.astype(np.float32), columns=[f'{column}_nbr_mean' for column in table.columns], index=table.index)
+
+def add_neighbour_features(store, columns, adjacency=None):
+    """Add <column>_nbr_mean columns for the listed X columns of a stage-3 region store."""
+    adjacency = read_adjacency(store) if adjacency is None else adjacency
+    X = store.read_table('X')
+    means = neighbour_means(adjacency, X[list(columns)], store.read_array('kept_su_ids', mmap_mode=None))
+    X[means.columns] = means
+    store.write_table('X', X)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build slope-unit adjacency graphs and neighbour features for existing stage-3 outputs.')
+    parser.add_argument('--output_dir', type=str, required=True, help='stage-3 output directory of region stores')
+    parser.add_argument('--columns', type=str, nargs='*', default=[], help='X columns to add neighbour means of')
+    args = parser.parse_args()
+    for region in list_region_stores(args.output_dir):
+        print('Processing region: ', region)
+        store = RegionStore(os.path.join(args.output_dir, region))
+        metadata = store.read_metadata()
+        with profiling.region(region):
+            adjacency = build_adjacency(store.read_array('slope_units'), metadata['n_units'], resolution=metadata['resolution'])
+            write_adjacency(store, adjacency)
+            if args.columns:
+                add_neighbour_features(store, args.columns, adjacency=adjacency)
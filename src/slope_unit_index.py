@@ -0,0 +1,130 @@
+import numpy as np
+
+from zonal_stats import ZONAL_STATS, ZONAL_CHUNK_PIXELS, _group_starts, _value_histogram, _histogram_mode
+
+INDEX_ORDER = 'su_index/order'
+INDEX_OFFSETS = 'su_index/offsets'
+
+def _order_dtype(n_pixels):
+    return np.dtype(np.uint32) if n_pixels <= np.iinfo(np.uint32).max else np.dtype(np.int64)
+
+def build_pixel_index(slope_units, n_units, store=None, chunk_pixels=ZONAL_CHUNK_PIXELS):
+    """
+    CSR layout of the pixels of every slope unit: order holds the flat pixel
+    indices sorted by unit (stable, so row-major within a unit) and the pixels
+    of unit i+1 are order[offsets[i]:offsets[i + 1]]. Pixels labelled 0 or
+    outside 1..n_units are left out.
+
+    Built as a counting sort over row chunks of the label raster, so only the
+    index itself is full size. With a store, order is written straight into
+    its memory-mapped array and both arrays are persisted there.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): order and offsets (length n_units + 1).
+    """
+    height, width = slope_units.shape
+    rows = max(1, chunk_pixels // max(1, width))
+    counts = np.zeros(n_units, dtype=np.int64)
+    for start in range(0, height, rows):
+        labels = slope_units[start:start + rows].ravel()
+        labels = labels[(labels >= 1) & (labels <= n_units)].astype(np.int64)
+        counts += np.bincount(labels - 1, minlength=n_units)
+    offsets = np.zeros(n_units + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    n_pixels = int(offsets[-1])
+    if store is not None:
+        order = store.create_array(INDEX_ORDER, (n_pixels,), _order_dtype(n_pixels))
+    else:
+        order = np.empty(n_pixels, dtype=_order_dtype(n_pixels))
+    cursor = offsets[:-1].copy()
+    for start in range(0, height, rows):
+        labels = slope_units[start:start + rows].ravel()
+        pixels = np.flatnonzero((labels >= 1) & (labels <= n_units))
+        unit_idx = labels[pixels].astype(np.int64) - 1
+        sort = np.argsort(unit_idx, kind='stable')
+        unit_idx, pixels = unit_idx[sort], pixels[sort] + start * width
+        starts = _group_starts(unit_idx)
+        run_counts = np.diff(np.r_[starts, len(unit_idx)])
+        rank = np.arange(len(unit_idx)) - np.repeat(starts, run_counts)
+        order[cursor[unit_idx] + rank] = pixels
+        cursor[unit_idx[starts]] += run_counts
+
+    if store is not None:
+        order.flush()
+        store.write_array(INDEX_OFFSETS, offsets)
+    return order, offsets
+
+def has_pixel_index(store):
+    return store.has_array(INDEX_ORDER) and store.has_array(INDEX_OFFSETS)
+
+def read_pixel_index(store, mmap_mode='r'):
+    """The (order, offsets) pixel index persisted by build_pixel_index."""
+    return store.read_array(INDEX_ORDER, mmap_mode=mmap_mode), store.read_array(INDEX_OFFSETS, mmap_mode=None)
+
+def _unit_blocks(offsets, chunk_pixels):
+    """Split units into consecutive [first, last) ranges covering roughly chunk_pixels pixels each."""
+    n_units = len(offsets) - 1
+    first = 0
+    while first < n_units:
+        last = int(np.searchsorted(offsets, offsets[first] + chunk_pixels, side='right')) - 1
+        last = min(n_units, max(first + 1, last))
+        yield first, last
+        first = last
+
+def indexed_zonal_stats(raster, order, offsets, stats=ZONAL_STATS, nodata=None, chunk_pixels=ZONAL_CHUNK_PIXELS):
+    """
+    Per-slope-unit statistics of a raster through a pixel index: the pixels of
+    each block of units are gathered contiguously and reduced segment by
+    segment, so no labels are scanned or sorted.
+
+    Args:
+        raster (numpy.ndarray): 2D feature raster on the grid the index was built on.
+        order, offsets (numpy.ndarray): Pixel index from build_pixel_index.
+        stats (iterable of str): Subset of ZONAL_STATS to compute.
+        nodata (number): Raster value (NaN allowed) excluded from every statistic.
+
+    Returns:
+        dict: stat name -> array of length n_units, where index i holds unit
+              i+1. Units without valid pixels are 0, as in zonal_stats.
+    """
+    stats = set(stats)
+    unknown = stats - set(ZONAL_STATS)
+    if unknown:
+        raise ValueError(f"Unknown zonal statistics: {sorted(unknown)}")
+    n_units = len(offsets) - 1
+    flat = raster.reshape(-1)
+    result = {stat: np.zeros(n_units, dtype=np.int64 if stat == 'count' else np.float64) for stat in stats}
+
+    for first, last in _unit_blocks(offsets, chunk_pixels):
+        values = flat[order[offsets[first]:offsets[last]]]
+        unit_idx = np.repeat(np.arange(last - first), np.diff(offsets[first:last + 1]))
+        if nodata is not None:
+            valid = ~np.isnan(values) if np.isnan(nodata) and values.dtype.kind == 'f' else values != nodata
+            values, unit_idx = values[valid], unit_idx[valid]
+        if len(values) == 0:
+            continue
+        values = values.astype(np.float64)
+        # values stay grouped by unit, so every unit is one segment
+        starts = _group_starts(unit_idx)
+        units = unit_idx[starts]
+        counts = np.diff(np.r_[starts, len(values)])
+        block = slice(first, last)
+        if 'count' in stats:
+            result['count'][block][units] = counts
+        if stats & {'sum', 'mean', 'var'}:
+            sums = np.add.reduceat(values, starts)
+            means = sums / counts
+            if 'sum' in stats:
+                result['sum'][block][units] = sums
+            if 'mean' in stats:
+                result['mean'][block][units] = means
+            if 'var' in stats:
+                result['var'][block][units] = np.add.reduceat((values - np.repeat(means, counts)) ** 2, starts) / counts
+        if 'min' in stats:
+            result['min'][block][units] = np.minimum.reduceat(values, starts)
+        if 'max' in stats:
+            result['max'][block][units] = np.maximum.reduceat(values, starts)
+        if 'mode' in stats:
+            result['mode'][block] = _histogram_mode(*_value_histogram(unit_idx, values), last - first)
+    return result
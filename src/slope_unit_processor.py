@@ -1,105 +1,311 @@
 import numpy as np
 import pandas as pd
 from scipy.stats import mode
-import pickle
 import rasterio
 import json
 import os
 import argparse
 
-def map_raster_to_slu(raster, slope_units, reduce_fn=np.mean, get_im=False):
-    raster = raster.astype(np.float32)
-    n_units = len(np.unique(slope_units))
+import zonal_stats as zonal_stats_module
+import raster_dtypes
+import slope_unit_index
+import slope_unit_graph
+from unit_maps import paint_units
+from zonal_stats import zonal_stats, count_units, row_chunks, ZonalAccumulator
+from region_store import RegionStore, list_region_stores
+import build_cache as bc
+from region_pipeline import run_pipelined, DEFAULT_PENDING_WRITES
+import profiling
+
+ZONAL_ENGINES = ('vectorized', 'loop')
+
+# continuous features that also get per-unit min and max columns
+EXTREME_FEATURES = ['slope', 'curv_mean', 'curv_total', 'curv_profile', 'drainage_area']
+
+# reduce functions used by the reference per-unit loop, keyed by zonal statistic
+LOOP_REDUCE_FNS = {
+    'mean': np.mean,
+    'var': np.var,
+    'min': np.min,
+    'max': np.max,
+    'sum': np.sum,
+    'mode': lambda x: mode(x).mode,
+}
+
+def map_raster_to_slu(raster, slope_units, reduce_fn=np.mean, get_im=False, n_units=None):
+    raster = raster.astype(np.float32, copy=False)
+    n_units = len(np.unique(slope_units)) if n_units is None else n_units
     feature_table = np.zeros(n_units, dtype=raster.dtype)
     for i in range(n_units):
         if np.any(slope_units == i+1) == 0:
             continue
         feature_table[i] = reduce_fn(raster[slope_units == i+1])
     if get_im:
-        feature_im = np.zeros_like(raster)
-        for i in range(n_units):
-            if np.any(slope_units == i+1) == 0:
-                continue
-            feature_im[slope_units == i+1] = feature_table[i]
-        return feature_table, feature_im
+        return feature_table, paint_units(feature_table, slope_units)
     return feature_table
 
-def process_region_slopeunits(region_file, min_count, out_file, categorical_feature_names=None):
-    categorical_feature_names = [] if categorical_feature_names is None else categorical_feature_names
+@profiling.profiled
+def compute_feature_stats(raster, slope_units, stats, engine='vectorized', n_units=None, nodata=None):
+    """
+    Compute several per-slope-unit statistics of one raster.
+
+    Args:
+        raster (numpy.ndarray): 2D feature raster.
+        slope_units (numpy.ndarray): 2D slope-unit label raster.
+        stats (list of str): Statistic names, see zonal_stats.ZONAL_STATS.
+        engine (str): 'vectorized' for the single-pass zonal_stats engine,
+                      'loop' for the reference per-unit map_raster_to_slu.
+        nodata (number): Raster value (NaN allowed) left out of the statistics.
+
+    Returns:
+        dict: stat name -> float32 array indexed by slope unit ID - 1.
+    """
+    if engine == 'vectorized':
+        result = zonal_stats(raster, slope_units, n_units=n_units, stats=stats, nodata=nodata)
+        return {stat: result[stat].astype(np.float32) for stat in stats}
+    if engine == 'loop':
+        n_units = count_units(slope_units) if n_units is None else n_units
+        invalid = raster_dtypes.nodata_mask(raster, nodata)
+        if invalid is not None:
+            slope_units = np.where(invalid, 0, slope_units)
+        return {stat: map_raster_to_slu(raster, slope_units, reduce_fn=LOOP_REDUCE_FNS[stat], n_units=n_units) for stat in stats}
+    raise ValueError(f"Unknown zonal engine '{engine}', expected one of {ZONAL_ENGINES}")
+
+def inventory_mean(packed_inventory, slope_units, n_units, engine='vectorized'):
+    """
+    Landslide fraction of every slope unit from the bit-packed inventory mask,
+    unpacked one row chunk at a time.
+    """
+    width = slope_units.shape[1]
+    if engine == 'loop':
+        inventory = raster_dtypes.unpack_rows(packed_inventory, width, 0, slope_units.shape[0])
+        return map_raster_to_slu(inventory, slope_units, reduce_fn=np.mean, n_units=n_units)
+    accumulator = ZonalAccumulator(n_units, stats=['mean'])
+    for start, stop in row_chunks(slope_units.shape):
+        accumulator.update(raster_dtypes.unpack_rows(packed_inventory, width, start, stop), slope_units[start:stop])
+    return accumulator.result()['mean'].astype(np.float32)
+
+def feature_stat_names(feat, categorical=False):
+    """
+    X columns of a feature: {column name: zonal statistic}. Categorical
+    features get their mode under the feature name, continuous ones mean and
+    variance, plus min and max for EXTREME_FEATURES.
+    """
+    if categorical:
+        return {feat: 'mode'}
+    stats = ['mean', 'var'] + (['min', 'max'] if feat in EXTREME_FEATURES else [])
+    return {f'{feat}_{stat}': stat for stat in stats}
+
+def load_region_inputs(region_path, mmap_mode='r'):
+    """
+    Open the stage-2 RegionStore at region_path for stage 3. With the default
+    mmap_mode arrays are memory-mapped and read as they are touched; with
+    mmap_mode=None everything is read up front (used to prefetch regions).
+    """
+    region = RegionStore(region_path)
+    metadata = region.read_metadata()
+    inputs = {
+        'path': region_path,
+        'metadata': metadata,
+        'centroids': region.read_array('centroids', mmap_mode=None),
+        'counts': region.read_array('counts', mmap_mode=None),
+        'slope_units': region.read_array('slopeunits', mmap_mode=mmap_mode),
+    }
+    if metadata['aggregation'] == 'streaming':
+        # per-unit statistics were accumulated window by window in stage 2
+        inputs['feature_stats'] = region.read_table('feature_stats')
+    else:
+        inputs['inventory'] = region.read_array('inventory', mmap_mode=mmap_mode)
+        if region.has_array('inventory_fraction'):
+            inputs['inventory_fraction'] = region.read_array('inventory_fraction', mmap_mode=mmap_mode)
+        inputs['features'] = {feat: region.read_array(f'features/{feat}', mmap_mode=mmap_mode) for feat in metadata['names']}
+    return inputs
 
-    with open(region_file, 'rb') as f:
-        region = pickle.load(f)
+@profiling.profiled
+def compute_region_slopeunits(inputs, min_count, categorical_feature_names=None, zonal_engine='vectorized', feature_engines=None,
+        neighbour_features=None):
+    """
+    The compute half of process_region_slopeunits: per-slope-unit feature
+    table, labels, centroids and adjacency graph of the units kept by min_count.
+    Feature bands are touched one at a time.
+    """
+    categorical_feature_names = [] if categorical_feature_names is None else categorical_feature_names
+    feature_engines = {} if feature_engines is None else feature_engines
 
-    slopeunits = region['slopeunits']
-    y = region['inventory']
-    X = region['features']
-    feature_names = region['names']
-    metadata = region['metadata']
-    centroids = region['centroids']
+    metadata = inputs['metadata']
+    feature_names = metadata['names']
+    n_units = metadata['n_units']
+    centroids = inputs['centroids']
+    counts_slu = inputs['counts']
+    slope_units = inputs['slope_units']
 
-    y_slu = map_raster_to_slu(y, slopeunits, reduce_fn=np.mean)
-    counts_slu = map_raster_to_slu(np.ones_like(y), slopeunits, reduce_fn=np.sum)
+    y_fraction = None
+    if metadata['aggregation'] == 'streaming':
+        stats_table = inputs['feature_stats']
+        y_slu = stats_table['inventory_mean'].to_numpy(dtype=np.float32)
+        if 'inventory_fraction_mean' in stats_table:
+            y_fraction = stats_table['inventory_fraction_mean'].to_numpy(dtype=np.float32)
+        stats_fn = lambda feat, stats, engine: {stat: stats_table[f'{feat}_{stat}'].to_numpy(dtype=np.float32) for stat in stats}
+    else:
+        nodata = metadata.get('nodata', {})
+        y_slu = inventory_mean(inputs['inventory'], slope_units, n_units, engine=zonal_engine)
+        if 'inventory_fraction' in inputs:
+            y_fraction = compute_feature_stats(inputs['inventory_fraction'], slope_units, ['mean'], engine=zonal_engine, n_units=n_units)['mean']
+        stats_fn = lambda feat, stats, engine: compute_feature_stats(inputs['features'][feat], slope_units, stats,
+            engine=engine, n_units=n_units, nodata=nodata.get(feat, np.nan))
 
-    extreme_features = ['slope', 'curv_mean', 'curv_total', 'curv_profile', 'drainage_area']
     feats, new_feat_names = [], []
-    for i, feat in enumerate(feature_names):
+    for feat in feature_names:
         print("Processing feature: ", feat)
-        if feat in categorical_feature_names:
-            feat_mode = map_raster_to_slu(X[i], slopeunits, reduce_fn=lambda x: mode(x).mode)
-            feats += [feat_mode]
-            new_feat_names += [feat]
-        else:
-            feat_mean = map_raster_to_slu(X[i], slopeunits, reduce_fn=np.mean)
-            feat_var = map_raster_to_slu(X[i], slopeunits, reduce_fn=np.var)
-            feats += [feat_mean, feat_var]
-            new_feat_names += [f'{feat}_mean', f'{feat}_var']
-            if feat in extreme_features:
-                feat_min = map_raster_to_slu(X[i], slopeunits, reduce_fn=np.min)
-                feat_max = map_raster_to_slu(X[i], slopeunits, reduce_fn=np.max)
-                feats += [feat_min, feat_max]
-                new_feat_names += [f'{feat}_min', f'{feat}_max']
+        engine = feature_engines.get(feat, zonal_engine)
+        stats = feature_stat_names(feat, feat in categorical_feature_names)
+        feat_stats = stats_fn(feat, list(stats.values()), engine)
+        feats += [feat_stats[stat] for stat in stats.values()]
+        new_feat_names += list(stats)
     feats = np.stack(feats)
 
     mask = counts_slu >= min_count
-    kept_su_ids = np.arange(1, len(np.unique(slopeunits)) + 1)[mask]
+    kept_su_ids = np.arange(1, n_units + 1)[mask]
     feats = feats[:,mask]
     y_slu = y_slu[mask]
+    y_fraction = y_fraction[mask] if y_fraction is not None else None
     counts_slu = counts_slu[mask]
     centroids = centroids[mask]
     X_slu = pd.DataFrame(feats, index=new_feat_names).T
+    adjacency = slope_unit_graph.build_adjacency(slope_units, n_units, resolution=metadata['resolution'])
+    if neighbour_features:
+        X_slu = X_slu.join(slope_unit_graph.neighbour_means(adjacency, X_slu[list(neighbour_features)], kept_su_ids))
     # for feat in categorical_feature_names:
     #     X_slu[feat] = X_slu[feat].astype(int)
 
-    data_dict = {
+    return {
+        'path': inputs['path'],
+        'metadata': metadata,
         'X': X_slu,
         'y': y_slu,
+        'y_fraction': y_fraction,
         'counts': counts_slu,
         'kept_su_ids': kept_su_ids,
-        'slope_units': slopeunits,
-        'metadata': metadata,
         'centroids': centroids,
+        'slope_units': slope_units,
+        'adjacency': adjacency,
     }
 
-    with open(out_file, 'wb') as f:
-        pickle.dump(data_dict, f)
+def write_region_slopeunits(out_path, result):
+    """Write a computed stage-3 region as a RegionStore at out_path, with its slope-unit pixel index and adjacency graph."""
+    metadata = result['metadata']
+    out = RegionStore.create(out_path)
+    out.write_table('X', result['X'])
+    out.write_array('y', result['y'])
+    if result['y_fraction'] is not None:
+        # landslide area fraction per unit, from the supersampled inventory raster
+        out.write_array('y_fraction', result['y_fraction'])
+    out.write_array('counts', result['counts'])
+    out.write_array('kept_su_ids', result['kept_su_ids'])
+    out.write_array('centroids', result['centroids'])
+    # the label raster is shared with the stage-2 store rather than rewritten
+    out.link_array('slope_units', RegionStore(result['path']), source_name='slopeunits')
+    # CSR pixel index of every unit, so single features can be added later without a rebuild
+    slope_unit_index.build_pixel_index(result['slope_units'], metadata['n_units'], store=out)
+    slope_unit_graph.write_adjacency(out, result['adjacency'])
+    out.write_metadata({key: value for key, value in metadata.items() if key not in ('aggregation', 'names', 'nodata')})
+
+@profiling.profiled
+def process_region_slopeunits(region_path, min_count, out_path, categorical_feature_names=None, zonal_engine='vectorized', feature_engines=None,
+        neighbour_features=None):
+    """
+    Stage 3 for one region: read the stage-2 RegionStore at region_path, compute
+    the per-slope-unit feature table and write it as a RegionStore at out_path.
+    Feature bands are memory-mapped and touched one at a time. The output
+    also holds the slope-unit pixel index used by add_feature and the
+    slope-unit adjacency graph; the X columns listed in neighbour_features
+    get <column>_nbr_mean neighbourhood columns.
+    """
+    result = compute_region_slopeunits(load_region_inputs(region_path), min_count, categorical_feature_names=categorical_feature_names,
+        zonal_engine=zonal_engine, feature_engines=feature_engines, neighbour_features=neighbour_features)
+    write_region_slopeunits(out_path, result)
 
-def process_slopeunits(input_dir, output_dir, data_json_path, min_slu_count=5):
+def process_slopeunits(input_dir, output_dir, data_json_path, min_slu_count=5, zonal_engine='vectorized', build_cache=None,
+        regions=None, on_region_done=None, prefetch=0, pending_writes=DEFAULT_PENDING_WRITES):
+    """
+    Stage 3 for every region store in input_dir. regions restricts the run to
+    a subset of region IDs; on_region_done(region) is called after each region
+    is written or skipped as unchanged. With prefetch > 0, the next prefetch
+    regions are read into memory in background threads while the current one
+    is computed, and outputs are written asynchronously (see
+    region_pipeline.run_pipelined).
+    """
     with open(data_json_path, 'r') as f:
         data_file_json = json.load(f)
         categorical_feature_names = list(data_file_json['categorical_features'].keys())
+        # optional per-feature override of the zonal statistics engine
+        feature_engines = data_file_json.get('zonal_engines', {})
+        # optional X columns that get neighbour-weighted means over the adjacency graph
+        neighbour_features = data_file_json.get('neighbour_features', [])
 
-    for region in os.listdir(input_dir):
-        print('Processing region: ', region.split('.')[0])
-        if region[0] == '.':
+    keys, pending = {}, []
+    for region in list_region_stores(input_dir):
+        if regions is not None and region not in regions:
             continue
-        region_file = os.path.join(input_dir, region)
-        output_file = os.path.join(output_dir, region)
-        process_region_slopeunits(region_file, min_slu_count, output_file, categorical_feature_names=categorical_feature_names)
+        if build_cache is not None:
+            keys[region] = build_cache.stage_key(
+                inputs=build_cache.hash_files([os.path.join(input_dir, region)]),
+                min_slu_count=min_slu_count,
+                categorical_feature_names=sorted(categorical_feature_names),
+                zonal_engine=zonal_engine,
+                feature_engines=feature_engines,
+                neighbour_features=neighbour_features,
+                code=bc.code_version(__file__, zonal_stats_module.__file__, raster_dtypes.__file__, slope_unit_index.__file__, slope_unit_graph.__file__),
+            )
+            if build_cache.is_fresh('stage3', region, keys[region]):
+                print('Skipping unchanged region: ', region)
+                if on_region_done is not None:
+                    on_region_done(region)
+                continue
+        pending.append(region)
+
+    def finish(region):
+        if build_cache is not None:
+            build_cache.record('stage3', region, keys[region], [os.path.join(output_dir, region)])
+        if on_region_done is not None:
+            on_region_done(region)
+
+    compute_kwargs = {
+        'categorical_feature_names': categorical_feature_names,
+        'zonal_engine': zonal_engine,
+        'feature_engines': feature_engines,
+        'neighbour_features': neighbour_features,
+    }
+    if prefetch > 0:
+        def compute(region, inputs):
+            print('Processing region: ', region)
+            return compute_region_slopeunits(inputs, min_slu_count, **compute_kwargs)
+        run_pipelined(
+            pending,
+            load=lambda region: load_region_inputs(os.path.join(input_dir, region), mmap_mode=None),
+            compute=compute,
+            write=lambda region, result: write_region_slopeunits(os.path.join(output_dir, region), result),
+            prefetch=prefetch,
+            pending_writes=pending_writes,
+            on_done=finish,
+            step_name='process_region_slopeunits',
+        )
+        return
+
+    for region in pending:
+        print('Processing region: ', region)
+        with profiling.region(region):
+            process_region_slopeunits(os.path.join(input_dir, region), min_slu_count, os.path.join(output_dir, region), **compute_kwargs)
+        finish(region)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_dir', type=str, required=True)
     parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--data_json_path', type=str, required=True)
     parser.add_argument('--min_slu_count', type=int, default=5)
+    parser.add_argument('--zonal_engine', type=str, default='vectorized', choices=ZONAL_ENGINES)
+    parser.add_argument('--prefetch', type=int, default=0, help='regions read ahead in background threads (0: sequential)')
     args = parser.parse_args()
-    process_slopeunits(args.input_dir, args.output_dir, args.min_slu_count)
\ No newline at end of file
+    process_slopeunits(args.input_dir, args.output_dir, args.data_json_path, min_slu_count=args.min_slu_count, zonal_engine=args.zonal_engine,
+        prefetch=args.prefetch)
\ No newline at end of file
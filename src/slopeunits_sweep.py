@@ -0,0 +1,172 @@
+from grass_region_processor import *
+from slope_unit_aggregate import aggregate_slope_units
+from slope_unit_processor import process_slopeunits
+from region_store import RegionStore, list_region_stores
+import itertools
+import shutil
+import time
+import numpy as np
+import pandas as pd
+
+def expand_grid(grid):
+    """
+    Cartesian product of a {parameter: [values]} grid, each configuration
+    completed with the defaults from SLOPEUNITS_PARAMS.
+
+    Returns:
+        dict: configuration ID -> full r.slopeunits parameter dict.
+    """
+    unknown = set(grid) - set(SLOPEUNITS_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown r.slopeunits parameters in grid: {sorted(unknown)}")
+    names = sorted(grid)
+    configs = {}
+    for i, values in enumerate(itertools.product(*(grid[name] for name in names))):
+        configs[f'config_{i:03d}'] = {**SLOPEUNITS_PARAMS, **dict(zip(names, values))}
+    return configs
+
+def _segment_task(task):
+    region_id, config_id, dem_map, params, region_out_dir = task
+    start = time.perf_counter()
+    try:
+        with profiling.region(region_id), profiling.step('segment_region', config=config_id):
+            # region and mask state are per mapset, so every worker sets them itself
+            grass_utils.set_subregion_bounds(region_id, 'elevation')
+            segment_region(region_id, dem_map, region_out_dir, slopeunits_params=params, map_prefix=f'{region_id}_{config_id}')
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return region_id, config_id, time.perf_counter() - start, error
+
+def _link_prepared_outputs(prep_dir, config_raw_dir):
+    """Expose the prepared (segmentation-independent) rasters of a region in a configuration's raw dump."""
+    setup_dir(config_raw_dir)
+    for filename in os.listdir(prep_dir):
+        if not filename.endswith('.tif') or filename == 'slopeunits.tif':
+            continue
+        dst = os.path.join(config_raw_dir, filename)
+        if not os.path.exists(dst):
+            os.symlink(os.path.abspath(os.path.join(prep_dir, filename)), dst)
+
+def summarize_config(config_id, params, agg_dir, out_dir, segment_times, stage23_time, resolution=None):
+    """One comparison-table row: unit counts, unit size distribution and runtimes of a configuration."""
+    sizes, kept = [], 0
+    for region in list_region_stores(agg_dir):
+        counts = RegionStore(os.path.join(agg_dir, region)).read_array('counts', mmap_mode=None)
+        sizes.append(counts[counts > 0])
+        kept += len(RegionStore(os.path.join(out_dir, region)).read_array('kept_su_ids'))
+    sizes = np.concatenate(sizes) if sizes else np.zeros(0)
+    pixel_area = abs(resolution[0] * resolution[1]) if resolution is not None else 1.0
+    quantiles = np.quantile(sizes, [0, 0.25, 0.5, 0.75, 1]) * pixel_area if len(sizes) else [np.nan] * 5
+    return {
+        'config': config_id,
+        **params,
+        'n_units': len(sizes),
+        'n_units_kept': kept,
+        'size_min': quantiles[0],
+        'size_p25': quantiles[1],
+        'size_median': quantiles[2],
+        'size_p75': quantiles[3],
+        'size_max': quantiles[4],
+        'size_mean': sizes.mean() * pixel_area if len(sizes) else np.nan,
+        'segment_total_s': sum(segment_times),
+        'segment_max_s': max(segment_times) if segment_times else np.nan,
+        'stage23_s': stage23_time,
+    }
+
+def run_sweep(data_json_path, regions_dir, sweep_dir, grid, workers=1, min_slu_count=5, streaming=True):
+    """
+    Run r.slopeunits for every configuration in the parameter grid and compare them.
+
+    Per-region preparation (region/mask, feature and inventory export) runs
+    once; the (region, configuration) segmentations then run concurrently in
+    temporary mapsets, and each configuration goes through stages 2-3 on
+    links to the shared prepared rasters. Writes <sweep_dir>/comparison.csv.
+    """
+    configs = expand_grid(grid)
+    setup_dir(sweep_dir)
+    with open(os.path.join(sweep_dir, 'configs.json'), 'w') as f:
+        json.dump(configs, f, indent=2)
+
+    with open(data_json_path, 'r') as f:
+        data_files = json.load(f)
+    continuous_features = ['elevation'] + list(data_files['features'].keys())
+    categorical_features = list(data_files['categorical_features'].keys())
+    feature_sources = {'elevation': data_files['elevation'], **data_files['features'], **data_files['categorical_features']}
+    feature_backends = {feature: 'grass' for feature in feature_sources}
+    feature_backends.update(data_files.get('feature_backends', {}))
+
+    # 1. shared preparation, once per region, in the main mapset so workers can read the maps
+    prep_dir = os.path.join(sweep_dir, 'prepared')
+    region_ids = get_region_files(regions_dir)
+    region_files = [os.path.join(regions_dir, f'{region_id}.shp') for region_id in region_ids]
+    resample_cache = warm_resample_cache(region_ids, region_files, continuous_features, categorical_features, feature_backends=feature_backends)
+    dem_maps = {}
+    for region_id, region_file in zip(region_ids, region_files):
+        print('Preparing region: ', region_id)
+        with profiling.region(region_id):
+            dem_maps[region_id] = prepare_region(region_id, region_file, prep_dir, continuous_features, categorical_features,
+                resample_cache=resample_cache, feature_sources=feature_sources, feature_backends=feature_backends)
+    grass_utils.clear_region_mask()
+
+    # 2. segmentations of every (region, configuration) pair in parallel
+    tasks = []
+    for config_id, params in configs.items():
+        for region_id in region_ids:
+            config_raw_dir = os.path.join(sweep_dir, config_id, 'dump_raw', region_id)
+            _link_prepared_outputs(os.path.join(prep_dir, region_id), config_raw_dir)
+            tasks.append((region_id, config_id, dem_maps[region_id], params, config_raw_dir))
+
+    segment_times = {config_id: [] for config_id in configs}
+    failed = set()
+    mapset_prefix = f'tmp_sweep_{uuid.uuid4().hex[:8]}_'
+    try:
+        with Pool(processes=max(1, workers), initializer=_init_region_worker, initargs=(mapset_prefix,)) as pool:
+            for region_id, config_id, elapsed, error in pool.imap_unordered(_segment_task, tasks):
+                print(f'Segmented {region_id} with {config_id} in {elapsed:.1f}s', '' if error is None else '(failed)')
+                segment_times[config_id].append(elapsed)
+                if error is not None:
+                    logging.error(f"Segmentation of {region_id} with {config_id} failed:\n{error}")
+                    failed.add((region_id, config_id))
+    finally:
+        config_manager.remove_temp_mapsets(mapset_prefix)
+
+    # 3. stages 2-3 per configuration, only for the slope-unit dependent work
+    rows = []
+    for config_id, params in configs.items():
+        config_dir = os.path.join(sweep_dir, config_id)
+        for region_id in region_ids:
+            if (region_id, config_id) in failed:
+                shutil.rmtree(os.path.join(config_dir, 'dump_raw', region_id), ignore_errors=True)
+        agg_dir = os.path.join(config_dir, 'dump_aggregated')
+        out_dir = os.path.join(config_dir, 'output')
+        setup_dir(agg_dir)
+        setup_dir(out_dir)
+        start = time.perf_counter()
+        aggregate_slope_units(os.path.join(config_dir, 'dump_raw'), agg_dir, data_json_path=data_json_path, streaming=streaming)
+        process_slopeunits(agg_dir, out_dir, data_json_path=data_json_path, min_slu_count=min_slu_count)
+        stage23_time = time.perf_counter() - start
+        stores = list_region_stores(agg_dir)
+        resolution = RegionStore(os.path.join(agg_dir, stores[0])).read_metadata()['resolution'] if stores else None
+        rows.append(summarize_config(config_id, params, agg_dir, out_dir, segment_times[config_id], stage23_time, resolution=resolution))
+
+    comparison = pd.DataFrame(rows)
+    comparison.to_csv(os.path.join(sweep_dir, 'comparison.csv'), index=False)
+    print(comparison.to_string(index=False))
+    return comparison
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sweep r.slopeunits parameters over a grid, reusing the per-region preparation.')
+    parser.add_argument('--sweep_dir', type=str, required=True)
+    parser.add_argument('--regions_dir', type=str, required=True)
+    parser.add_argument('--data_json_path', type=str, required=True)
+    parser.add_argument('--grid', type=str, required=True, help='JSON file mapping r.slopeunits parameters to lists of values')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--min_slu_count', type=int, default=5)
+    parser.add_argument('--no_streaming', action='store_true', help='stack feature rasters in stage 2 instead of streaming them')
+    args = parser.parse_args()
+
+    with open(args.grid, 'r') as f:
+        grid = json.load(f)
+    run_sweep(args.data_json_path, args.regions_dir, args.sweep_dir, grid, workers=args.workers,
+        min_slu_count=args.min_slu_count, streaming=not args.no_streaming)
@@ -0,0 +1,95 @@
+import numpy as np
+import os
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# synthetic regions are written in strips of this many pixels, so generating 1e9-pixel rasters needs bounded memory
+WRITE_WINDOW_PIXELS = 1 << 24
+
+SYNTHETIC_CRS = 'EPSG:32648'
+SYNTHETIC_RESOLUTION = 30.0
+
+def _block_layout(height, width, n_units, seed):
+    """Random assignment of IDs 1..n_units to a grid of roughly square blocks covering the raster."""
+    rng = np.random.default_rng(seed)
+    blocks = int(np.ceil(np.sqrt(n_units)))
+    block_ids = rng.permutation(blocks * blocks) % n_units + 1
+    rows = np.minimum(np.arange(height, dtype=np.int64) * blocks // height, blocks - 1)
+    cols = np.minimum(np.arange(width, dtype=np.int64) * blocks // width, blocks - 1)
+    return blocks, block_ids, rows, cols
+
+def make_slope_units(height, width, n_units, seed=0, row_off=0, n_rows=None):
+    """
+    Label raster of contiguous blocks with IDs 1..n_units (rows row_off to
+    row_off + n_rows of the full height x width raster).
+    """
+    n_rows = height - row_off if n_rows is None else n_rows
+    blocks, block_ids, rows, cols = _block_layout(height, width, n_units, seed)
+    rows = rows[row_off:row_off + n_rows]
+    return block_ids[rows[:, None] * blocks + cols[None, :]].astype(np.uint32)
+
+def make_synthetic_region(height, width, n_units, n_categories=8, seed=0):
+    """
+    Build a label raster (contiguous-ish blocks of IDs 1..n_units) with one
+    continuous and one categorical feature raster on the same grid.
+    """
+    rng = np.random.default_rng(seed)
+    slope_units = make_slope_units(height, width, n_units, seed=seed)
+    continuous = rng.normal(100, 25, size=(height, width)).astype(np.float32)
+    categorical = rng.integers(1, n_categories + 1, size=(height, width)).astype(np.float32)
+    return slope_units, continuous, categorical
+
+def write_synthetic_region(region_dir, height, width, n_units, n_features=4, n_categorical=1, n_categories=8, seed=0):
+    """
+    Write a stage-1-style region directory of GeoTIFFs (slopeunits, inventory,
+    region and n_features feature rasters, the last n_categorical of them
+    categorical), strip by strip.
+
+    Returns:
+        list of str: names of the categorical features.
+    """
+    os.makedirs(region_dir, exist_ok=True)
+    profile = {
+        'driver': 'GTiff',
+        'height': height,
+        'width': width,
+        'count': 1,
+        'crs': SYNTHETIC_CRS,
+        'transform': from_origin(500000.0, 3500000.0, SYNTHETIC_RESOLUTION, SYNTHETIC_RESOLUTION),
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'BIGTIFF': 'IF_SAFER',
+    }
+    names = [f'feature_{i}' for i in range(n_features - n_categorical)] + [f'category_{i}' for i in range(n_categorical)]
+    categorical = names[len(names) - n_categorical:]
+    rasters = {
+        'slopeunits': 'uint32',
+        'inventory': 'float32',
+        'region': 'float32',
+        **{name: 'float32' for name in names},
+    }
+    datasets = {
+        name: rasterio.open(os.path.join(region_dir, f'{name}.tif'), 'w', dtype=dtype, **profile)
+        for name, dtype in rasters.items()
+    }
+    rng = np.random.default_rng(seed)
+    try:
+        strip = max(256, (WRITE_WINDOW_PIXELS // width) // 256 * 256)
+        for row_off in range(0, height, strip):
+            n_rows = min(strip, height - row_off)
+            window = Window(0, row_off, width, n_rows)
+            datasets['slopeunits'].write(make_slope_units(height, width, n_units, seed=seed, row_off=row_off, n_rows=n_rows), 1, window=window)
+            datasets['inventory'].write((rng.random((n_rows, width)) < 0.05).astype(np.float32), 1, window=window)
+            datasets['region'].write(np.ones((n_rows, width), dtype=np.float32), 1, window=window)
+            for name in names:
+                if name in categorical:
+                    values = rng.integers(1, n_categories + 1, size=(n_rows, width)).astype(np.float32)
+                else:
+                    values = rng.normal(100, 25, size=(n_rows, width)).astype(np.float32)
+                datasets[name].write(values, 1, window=window)
+    finally:
+        for dataset in datasets.values():
+            dataset.close()
+    return categorical
@@ -0,0 +1,154 @@
+import numpy as np
+import math
+import rasterio
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+import raster_dtypes
+import profiling
+
+# default overlap, in pixels, added around every tile core
+DEFAULT_HALO = 256
+
+def plan_tiles(height, width, pixel_budget, halo=DEFAULT_HALO):
+    """
+    Split a height x width grid into a regular grid of core tiles such that
+    every tile grown by halo pixels on each side (clipped to the grid) holds at
+    most pixel_budget pixels. The halo must be at least one pixel, since
+    stitching compares the pixels on both sides of every seam in both tiles.
+
+    Returns:
+        list of dict: per tile its 'index' (row, col) in the tile grid, 'core'
+            and 'extent' windows as (row_start, row_stop, col_start, col_stop).
+    """
+    if halo < 1:
+        raise ValueError(f"Tiles need a halo of at least 1 pixel, got {halo}")
+    side = math.isqrt(int(pixel_budget)) - 2 * halo
+    if side < 1:
+        raise ValueError(f"A pixel budget of {pixel_budget} leaves no room for tiles with a halo of {halo} pixels")
+    n_rows, n_cols = max(1, math.ceil(height / side)), max(1, math.ceil(width / side))
+    row_edges = np.linspace(0, height, n_rows + 1).round().astype(int)
+    col_edges = np.linspace(0, width, n_cols + 1).round().astype(int)
+    tiles = []
+    for i in range(n_rows):
+        for j in range(n_cols):
+            core = (int(row_edges[i]), int(row_edges[i + 1]), int(col_edges[j]), int(col_edges[j + 1]))
+            extent = (max(0, core[0] - halo), min(height, core[1] + halo), max(0, core[2] - halo), min(width, core[3] + halo))
+            tiles.append({'index': (i, j), 'core': core, 'extent': extent})
+    return tiles
+
+def tile_bounds(extent, region):
+    """GRASS region bounds (n, s, e, w) of a tile extent within a region dict with n, w, nsres, ewres."""
+    row_start, row_stop, col_start, col_stop = extent
+    return {
+        'n': region['n'] - row_start * region['nsres'],
+        's': region['n'] - row_stop * region['nsres'],
+        'w': region['w'] + col_start * region['ewres'],
+        'e': region['w'] + col_stop * region['ewres'],
+    }
+
+def _read_tile(path, tile):
+    """Labels of a UInt32 tile export (nodata as 0), checked against its planned extent."""
+    with rasterio.open(path) as src:
+        labels = src.read(1)
+        nodata = src.nodata
+    row_start, row_stop, col_start, col_stop = tile['extent']
+    if labels.shape != (row_stop - row_start, col_stop - col_start):
+        raise ValueError(f"Tile {tile['index']} has shape {labels.shape}, expected {(row_stop - row_start, col_stop - col_start)}")
+    return raster_dtypes.to_labels(labels, nodata, np.uint32)
+
+def _local(tile, rows, cols):
+    """Planned full-grid pixel coordinates -> coordinates inside a tile's extent."""
+    return rows - tile['extent'][0], cols - tile['extent'][2]
+
+def _seam_pairs(t, u, labels_t, labels_u, offsets, horizontal):
+    """
+    Fragment pairs across the seam between tile t and its right (horizontal)
+    or lower neighbour u, and whether both tiles put the two seam pixels in
+    the same unit (each sees the other's side through its halo).
+    """
+    if horizontal:
+        rows = np.arange(t['core'][0], t['core'][1])
+        p = (rows, np.full(len(rows), t['core'][3] - 1))
+        q = (rows, np.full(len(rows), u['core'][2]))
+    else:
+        cols = np.arange(t['core'][2], t['core'][3])
+        p = (np.full(len(cols), t['core'][1] - 1), cols)
+        q = (np.full(len(cols), u['core'][0]), cols)
+    t_p, t_q = labels_t[_local(t, *p)].astype(np.int64), labels_t[_local(t, *q)].astype(np.int64)
+    u_p, u_q = labels_u[_local(u, *p)].astype(np.int64), labels_u[_local(u, *q)].astype(np.int64)
+    valid = (t_p > 0) & (u_q > 0) & (t_q > 0) & (u_p > 0)
+    agree = (t_p == t_q) & (u_p == u_q)
+    fragment_p = t_p[valid] + offsets[t['index']]
+    fragment_q = u_q[valid] + offsets[u['index']]
+    return fragment_p, fragment_q, agree[valid]
+
+@profiling.profiled
+def stitch_tiles(tiles, tile_paths, height, width):
+    """
+    Stitch separately segmented overlapping tiles into one label raster.
+
+    Every pixel takes the label of the tile whose core contains it, offset so
+    IDs are unique across tiles. Fragments of the same unit cut by a core seam
+    are then merged: across each seam, a pair of fragments is merged when for
+    most of their shared seam pixels both tiles (each seeing the other side
+    through its halo) assigned the two pixels to the same unit. Finally IDs
+    are relabelled to be contiguous from 1, keeping 0 for nodata.
+
+    Returns:
+        numpy.ndarray: (height, width) label raster in the narrowest unsigned dtype.
+    """
+    labels = {tile['index']: _read_tile(path, tile) for tile, path in zip(tiles, tile_paths)}
+    offsets, total = {}, 0
+    for tile in tiles:
+        offsets[tile['index']] = total
+        total += int(labels[tile['index']].max(initial=0))
+
+    stitched = np.zeros((height, width), dtype=raster_dtypes.label_dtype(total))
+    for tile in tiles:
+        row_start, row_stop, col_start, col_stop = tile['core']
+        row_off, col_off = tile['extent'][0], tile['extent'][2]
+        core = labels[tile['index']][row_start - row_off:row_stop - row_off, col_start - col_off:col_stop - col_off]
+        stitched[row_start:row_stop, col_start:col_stop] = np.where(core > 0, core.astype(stitched.dtype) + offsets[tile['index']], 0)
+
+    by_index = {tile['index']: tile for tile in tiles}
+    fragments_p, fragments_q, agreements = [], [], []
+    for tile in tiles:
+        i, j = tile['index']
+        for neighbour, horizontal in (((i, j + 1), True), ((i + 1, j), False)):
+            if neighbour in by_index:
+                pairs = _seam_pairs(tile, by_index[neighbour], labels[tile['index']], labels[neighbour], offsets, horizontal)
+                fragments_p.append(pairs[0])
+                fragments_q.append(pairs[1])
+                agreements.append(pairs[2])
+    del labels
+
+    if fragments_p:
+        fragment_p, fragment_q, agree = (np.concatenate(parts) for parts in (fragments_p, fragments_q, agreements))
+        keys, inverse = np.unique(fragment_p * (total + 1) + fragment_q, return_inverse=True)
+        seam_length = np.bincount(inverse, minlength=len(keys))
+        agreeing = np.bincount(inverse, weights=agree, minlength=len(keys))
+        merged = keys[2 * agreeing > seam_length]
+        graph = sp.coo_matrix((np.ones(len(merged)), np.divmod(merged, total + 1)), shape=(total + 1, total + 1))
+        _, component = connected_components(graph, directed=False)
+    else:
+        component = np.arange(total + 1)
+
+    # contiguous IDs from 1, one per merged unit that still has pixels
+    component = component.astype(np.int64)
+    present = np.zeros(total + 1, dtype=bool)
+    present[stitched.ravel()] = True
+    present[0] = False
+    unit_ids = np.unique(component[present])
+    relabel = np.zeros(total + 1, dtype=np.int64)
+    relabel[present] = np.searchsorted(unit_ids, component[present]) + 1
+    return relabel.astype(raster_dtypes.label_dtype(len(unit_ids)))[stitched]
+
+def write_labels(labels, out_path, grid_path):
+    """Write a label raster as a UInt32 GeoTIFF on the grid of grid_path (e.g. region.tif), 0 as nodata."""
+    with rasterio.open(grid_path) as src:
+        profile = {'driver': 'GTiff', 'height': src.height, 'width': src.width, 'count': 1, 'crs': src.crs, 'transform': src.transform}
+    if labels.shape != (profile['height'], profile['width']):
+        raise ValueError(f"Stitched labels have shape {labels.shape}, grid is {(profile['height'], profile['width'])}")
+    with rasterio.open(out_path, 'w', dtype='uint32', nodata=0, **profile) as out:
+        out.write(labels.astype(np.uint32, copy=False), 1)
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from region_store import RegionStore, list_region_stores
+from zonal_stats import row_chunks
+import profiling
+
+DEFAULT_BLOCK_SIZE = 512
+# per-unit columns of a stage-3 store that are not in the X table
+STORE_COLUMNS = ('y', 'y_fraction', 'counts')
+
+def unit_lut(n_units, su_ids, values, fill=np.nan, dtype=np.float32):
+    """
+    Lookup table mapping a slope-unit ID to its value: entry 0 (nodata) and
+    units missing from su_ids get fill. A trailing fill entry catches labels
+    above n_units (e.g. an undeclared nodata value) in gather.
+    """
+    lut = np.full(n_units + 2, fill, dtype=dtype)
+    lut[np.asarray(su_ids, dtype=np.int64)] = values
+    return lut
+
+def gather(lut, slope_units):
+    """lut[slope_units], with labels past the end of the table mapped to its trailing fill entry."""
+    return np.take(lut, slope_units, mode='clip')
+
+def paint_units(table, slope_units, fill=0):
+    """
+    Per-unit values (table[i] for unit ID i+1) painted back onto the label
+    raster with a single lookup-table gather; fill for label 0.
+    """
+    table = np.asarray(table)
+    return gather(unit_lut(len(table), np.arange(1, len(table) + 1), table, fill=fill, dtype=table.dtype), slope_units)
+
+def column_lut(store, column, metadata=None, fill=np.nan):
+    """Lookup table of a stage-3 X column (or y / y_fraction / counts) over the kept units of a region store."""
+    metadata = store.read_metadata() if metadata is None else metadata
+    if column in STORE_COLUMNS:
+        values = store.read_array(column, mmap_mode=None)
+    else:
+        values = store.read_table('X', columns=[column])[column].to_numpy()
+    return unit_lut(metadata['n_units'], store.read_array('kept_su_ids', mmap_mode=None), values, fill=fill)
+
+def overview_factors(height, width, block_size=DEFAULT_BLOCK_SIZE):
+    """Overview decimation factors 2, 4, ... until the overview fits in one block."""
+    factors, factor = [], 2
+    while max(height, width) / (factor // 2) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+@profiling.profiled
+def write_cog(lut, slope_units, out_path, transform, crs, block_size=DEFAULT_BLOCK_SIZE, compress='deflate', resampling='nearest'):
+    """
+    Write the map gather(lut, slope_units) as a Cloud-Optimized GeoTIFF: the
+    map is painted row chunk by row chunk into a tiled temporary GeoTIFF,
+    overviews are built, and the result is copied with its overviews into COG
+    layout (tiled, compressed, overviews ahead of the full-resolution data).
+    """
+    height, width = slope_units.shape
+    nodata = np.nan if np.issubdtype(lut.dtype, np.floating) else 0
+    profile = {
+        'driver': 'GTiff', 'height': height, 'width': width, 'count': 1, 'dtype': lut.dtype.name, 'nodata': nodata,
+        'crs': crs, 'transform': transform, 'tiled': True, 'blockxsize': block_size, 'blockysize': block_size,
+    }
+    tmp_path = f'{out_path}.tmp.tif'
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        for start, stop in row_chunks(slope_units.shape, chunk_pixels=block_size * max(width, block_size) * 8):
+            dst.write(gather(lut, slope_units[start:stop]), 1, window=Window(0, start, width, stop - start))
+        dst.build_overviews(overview_factors(height, width, block_size), Resampling[resampling])
+        dst.update_tags(ns='rio_overview', resampling=resampling)
+    try:
+        rasterio.shutil.copy(tmp_path, out_path, driver='GTiff', tiled=True, blockxsize=block_size, blockysize=block_size,
+            compress=compress, predictor=3 if np.issubdtype(lut.dtype, np.floating) else 2, copy_src_overviews=True)
+    finally:
+        os.remove(tmp_path)
+
+def export_region_maps(region_path, columns, out_dir, values=None, **cog_kwargs):
+    """
+    Write one COG per column of a stage-3 region store as
+    <out_dir>/<region>_<column>.tif, on the grid stored in its metadata.
+    values optionally maps extra column names to (su_ids, values) pairs, e.g.
+    model predictions, painted the same way.
+
+    Returns:
+        list of str: the files written.
+    """
+    store = RegionStore(region_path)
+    metadata = store.read_metadata()
+    region = os.path.basename(os.path.normpath(region_path))
+    slope_units = store.read_array('slope_units')
+    luts = {column: column_lut(store, column, metadata) for column in columns}
+    for column, (su_ids, column_values) in (values or {}).items():
+        luts[column] = unit_lut(metadata['n_units'], su_ids, column_values)
+
+    paths = []
+    for column, lut in luts.items():
+        out_path = os.path.join(out_dir, f'{region}_{column}.tif')
+        write_cog(lut, slope_units, out_path, metadata['transform'], metadata['crs'], **cog_kwargs)
+        paths.append(out_path)
+    return paths
+
+def export_maps(output_dir, out_dir, columns, regions=None, table_path=None, value_columns=None, **cog_kwargs):
+    """
+    export_region_maps for every stage-3 region store in output_dir (or the
+    listed regions). table_path is an optional Parquet table with region and
+    su_id columns (e.g. predictions over an exported dataset) whose
+    value_columns are mapped as well.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    table = pd.read_parquet(table_path, columns=['region', 'su_id'] + list(value_columns)) if table_path is not None else None
+    for region in list_region_stores(output_dir):
+        if regions is not None and region not in regions:
+            continue
+        values = None
+        if table is not None:
+            rows = table[table['region'].astype(str) == region]
+            values = {column: (rows['su_id'].to_numpy(), rows[column].to_numpy()) for column in value_columns}
+        print('Exporting maps of region: ', region)
+        with profiling.region(region):
+            export_region_maps(os.path.join(output_dir, region), columns, out_dir, values=values, **cog_kwargs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export per-unit columns of stage-3 outputs as Cloud-Optimized GeoTIFF maps.')
+    parser.add_argument('--output_dir', type=str, required=True, help='stage-3 output directory of region stores')
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--columns', type=str, nargs='*', default=[], help='X columns, y, y_fraction or counts')
+    parser.add_argument('--regions', type=str, nargs='+', default=None)
+    parser.add_argument('--table_path', type=str, default=None, help='Parquet table with region, su_id and value columns')
+    parser.add_argument('--value_columns', type=str, nargs='*', default=[])
+    parser.add_argument('--block_size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--compress', type=str, default='deflate')
+    parser.add_argument('--resampling', type=str, default='nearest', help='overview resampling, e.g. nearest or average')
+    args = parser.parse_args()
+    export_maps(args.output_dir, args.out_dir, args.columns, regions=args.regions, table_path=args.table_path, value_columns=args.value_columns,
+        block_size=args.block_size, compress=args.compress, resampling=args.resampling)
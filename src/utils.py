@@ -2,10 +2,11 @@ import os
 import shutil
 
 def setup_dir(dirname):
-    if not os.path.exists(dirname):
+    # concurrent queue workers may create the same directory at once
+    try:
         os.makedirs(dirname)
         print(f"Directory '{dirname}' created.")
-    else:
+    except FileExistsError:
         print(f"Directory '{dirname}' already exists.")
 
 def clean_dir(dirname):
@@ -0,0 +1,312 @@
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from utils import setup_dir
+from pipeline_state import STAGES, select_stages
+import profiling
+
+DEFAULT_LEASE_SECONDS = 600
+DEFAULT_MAX_ATTEMPTS = 3
+
+class RegionQueue:
+    """
+    Region work queue in a SQLite file on a filesystem shared by all workers.
+
+    Workers claim a region by taking a lease, keep it alive with heartbeats
+    and mark it done or failed. A lease that is not renewed within
+    lease_seconds (crashed or hung worker) is put back to pending on the next
+    claim; a region that failed or expired max_attempts times is left failed.
+    Every operation is its own short IMMEDIATE transaction on a fresh
+    connection, so any number of processes and threads can share the file;
+    on a network filesystem it relies on its POSIX locks working.
+    """
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS regions (
+                    region_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    updated REAL
+                )
+            """)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def add(self, region_ids):
+        """Enqueue regions; regions already in the queue keep their state."""
+        with self._transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO regions (region_id, updated) VALUES (?, ?)", [(region_id, time.time()) for region_id in region_ids])
+
+    def reset(self, states=('failed',)):
+        """Put regions in the given states back to pending with a fresh attempt count."""
+        with self._transaction() as db:
+            db.execute(f"UPDATE regions SET state = 'pending', worker = NULL, lease_expires = NULL, attempts = 0, error = NULL, updated = ? "
+                f"WHERE state IN ({','.join('?' * len(states))})", (time.time(), *states))
+
+    def _requeue_expired(self, db, now):
+        db.execute("UPDATE regions SET state = 'failed', worker = NULL, lease_expires = NULL, error = 'lease expired', updated = ? "
+            "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+        db.execute("UPDATE regions SET state = 'pending', worker = NULL, lease_expires = NULL, updated = ? "
+            "WHERE state = 'leased' AND lease_expires < ?", (now, now))
+
+    def claim(self, worker_id):
+        """Lease the next pending region to worker_id; None once nothing is pending."""
+        now = time.time()
+        with self._transaction() as db:
+            self._requeue_expired(db, now)
+            row = db.execute("SELECT region_id FROM regions WHERE state = 'pending' ORDER BY attempts, region_id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE regions SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE region_id = ?",
+                (worker_id, now + self.lease_seconds, now, row[0]))
+            return row[0]
+
+    def heartbeat(self, region_id, worker_id):
+        """Extend worker_id's lease on region_id; False if the lease was lost."""
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE regions SET lease_expires = ?, updated = ? WHERE region_id = ? AND worker = ? AND state = 'leased'",
+                (now + self.lease_seconds, now, region_id, worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, region_id, worker_id):
+        """Mark a leased region done; False if worker_id no longer held the lease."""
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE regions SET state = 'done', lease_expires = NULL, error = NULL, updated = ? WHERE region_id = ? AND worker = ? AND state = 'leased'",
+                (time.time(), region_id, worker_id))
+            return cursor.rowcount == 1
+
+    def fail(self, region_id, worker_id, error):
+        """Release a leased region after an error: back to pending, or failed after max_attempts."""
+        with self._transaction() as db:
+            db.execute("UPDATE regions SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, lease_expires = NULL, error = ?, updated = ? "
+                "WHERE region_id = ? AND worker = ? AND state = 'leased'", (self.max_attempts, error, time.time(), region_id, worker_id))
+
+    def status(self):
+        """Number of regions per state."""
+        with self._transaction() as db:
+            return dict(db.execute("SELECT state, COUNT(*) FROM regions GROUP BY state").fetchall())
+
+    def failures(self):
+        with self._transaction() as db:
+            return dict(db.execute("SELECT region_id, error FROM regions WHERE state = 'failed'").fetchall())
+
+class LeaseLost(RuntimeError):
+    """Raised when a worker finds its lease on a region taken over by another worker."""
+
+class Heartbeat:
+    """
+    Background thread renewing a region lease every lease_seconds / 3 while
+    the region is processed. check() renews and verifies the lease on the
+    spot, so work can stop before it writes outputs another worker now owns.
+    """
+
+    def __init__(self, queue, region_id, worker_id):
+        self.queue = queue
+        self.region_id = region_id
+        self.worker_id = worker_id
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            if not self.queue.heartbeat(self.region_id, self.worker_id):
+                self.lost = True
+                logging.warning(f"Worker {self.worker_id} lost its lease on region {self.region_id}")
+                return
+
+    def check(self):
+        """Raise LeaseLost unless worker_id still holds the lease (renewing it)."""
+        if self.lost or not self.queue.heartbeat(self.region_id, self.worker_id):
+            self.lost = True
+            raise LeaseLost(f"Worker {self.worker_id} lost its lease on region {self.region_id}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def run_region(region_id, stages, data_json_path, regions_dir, output_dir, min_slu_count=5, streaming=False, zonal_engine='vectorized', feature_backend='grass',
+        check_lease=None):
+    """
+    Run the selected stages for one region, with main.py's output layout under
+    output_dir. check_lease() is called before each stage writes its outputs
+    and raises (LeaseLost) once the region belongs to another worker, so a
+    stale worker never replaces the new leaseholder's directories.
+    """
+    check_lease = (lambda: None) if check_lease is None else check_lease
+    raw_dump_dir = os.path.join(output_dir, 'dump_raw')
+    aggregated_dump_dir = os.path.join(output_dir, 'dump_aggregated')
+    slopeunits_output_dir = os.path.join(output_dir, 'output')
+    if 1 in stages:
+        from grass_region_processor import process_subregions
+        check_lease()
+        setup_dir(raw_dump_dir)
+        # the resample cache pays off across regions of one process only, so resample per region here
+        failures = process_subregions(data_json_path, regions_dir, raw_dump_dir, use_resample_cache=False, feature_backend=feature_backend, regions=[region_id])
+        if region_id in failures:
+            raise RuntimeError(f"Stage 1 failed:\n{failures[region_id]}")
+    if 2 in stages:
+        from slope_unit_aggregate import aggregate_slope_units
+        if not os.path.isdir(os.path.join(raw_dump_dir, region_id)):
+            raise FileNotFoundError(f"No stage-1 output for region {region_id} in {raw_dump_dir}")
+        check_lease()
+        setup_dir(aggregated_dump_dir)
+        aggregate_slope_units(raw_dump_dir, aggregated_dump_dir, data_json_path=data_json_path, streaming=streaming, regions=[region_id])
+    if 3 in stages:
+        from slope_unit_processor import process_slopeunits
+        from region_store import is_region_store
+        if not is_region_store(os.path.join(aggregated_dump_dir, region_id)):
+            raise FileNotFoundError(f"No stage-2 output for region {region_id} in {aggregated_dump_dir}")
+        check_lease()
+        setup_dir(slopeunits_output_dir)
+        process_slopeunits(aggregated_dump_dir, slopeunits_output_dir, data_json_path, min_slu_count=min_slu_count, zonal_engine=zonal_engine, regions=[region_id])
+
+def run_worker(queue_path, stages=STAGES, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS, **region_kwargs):
+    """
+    Claim and process regions from the queue until none are pending. A worker
+    running stage 1 works in its own temporary GRASS mapset.
+
+    Returns:
+        int: number of regions this worker completed.
+    """
+    worker_id = f'{socket.gethostname()}:{os.getpid()}' if worker_id is None else worker_id
+    queue = RegionQueue(queue_path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    mapset_prefix = None
+    if 1 in stages:
+        from setup import get_config_manager
+        mapset_prefix = f'tmp_queue_{uuid.uuid4().hex[:8]}_'
+        get_config_manager().use_temp_mapset(f'{mapset_prefix}{os.getpid()}')
+
+    completed = 0
+    try:
+        while True:
+            region_id = queue.claim(worker_id)
+            if region_id is None:
+                break
+            print(f'Worker {worker_id} claimed region: ', region_id)
+            with Heartbeat(queue, region_id, worker_id) as heartbeat:
+                try:
+                    with profiling.region(region_id), profiling.step('queue_region', worker=worker_id):
+                        run_region(region_id, stages, check_lease=heartbeat.check, **region_kwargs)
+                    error = None
+                except LeaseLost:
+                    error = None
+                except Exception:
+                    error = traceback.format_exc()
+            if heartbeat.lost:
+                # the region belongs to another worker now; neither fail nor complete it
+                logging.warning(f"Region {region_id} abandoned on worker {worker_id} after its lease expired")
+            elif error is not None:
+                logging.error(f"Region {region_id} failed on worker {worker_id}:\n{error}")
+                queue.fail(region_id, worker_id, error)
+            elif not queue.complete(region_id, worker_id):
+                logging.warning(f"Region {region_id} finished on worker {worker_id} after its lease expired")
+            else:
+                completed += 1
+    finally:
+        if mapset_prefix is not None:
+            from setup import get_config_manager
+            get_config_manager().remove_temp_mapsets(mapset_prefix)
+    print(f'Worker {worker_id} done, completed {completed} regions')
+    return completed
+
+def run_local_workers(n_workers, queue_path, **worker_kwargs):
+    """Start n_workers worker processes on this host and wait for them."""
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(queue_path,), kwargs=worker_kwargs) for _ in range(n_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Region work queue for running the pipeline on several workers or hosts.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = subparsers.add_parser('init', help='enqueue regions')
+    init_parser.add_argument('--queue', type=str, required=True, help='SQLite queue file on a shared filesystem')
+    init_parser.add_argument('--regions_dir', type=str, default=None, help='enqueue every region vector in this directory')
+    init_parser.add_argument('--regions', type=str, nargs='+', default=None)
+    init_parser.add_argument('--retry_failed', action='store_true', help='put failed regions back to pending')
+
+    worker_parser = subparsers.add_parser('worker', help='claim and process regions until the queue is drained')
+    worker_parser.add_argument('--queue', type=str, required=True)
+    worker_parser.add_argument('--output_dir', type=str, required=True)
+    worker_parser.add_argument('--data_json_path', type=str, required=True)
+    worker_parser.add_argument('--regions_dir', type=str, default=None, help='required when stage 1 runs')
+    worker_parser.add_argument('--stages', type=int, nargs='+', default=None, choices=STAGES)
+    worker_parser.add_argument('--workers', type=int, default=1, help='worker processes to start on this host')
+    worker_parser.add_argument('--lease_seconds', type=float, default=DEFAULT_LEASE_SECONDS)
+    worker_parser.add_argument('--max_attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    worker_parser.add_argument('--min_slu_count', type=int, default=5)
+    worker_parser.add_argument('--streaming', action='store_true')
+    worker_parser.add_argument('--zonal_engine', type=str, default='vectorized', choices=['vectorized', 'loop'])
+    worker_parser.add_argument('--feature_backend', type=str, default='grass', choices=['grass', 'rasterio'])
+
+    status_parser = subparsers.add_parser('status', help='print the number of regions per state')
+    status_parser.add_argument('--queue', type=str, required=True)
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        queue = RegionQueue(args.queue)
+        region_ids = list(args.regions or [])
+        if args.regions_dir is not None:
+            from setup import get_region_files
+            region_ids += get_region_files(args.regions_dir)
+        queue.add(sorted(set(region_ids)))
+        if args.retry_failed:
+            queue.reset(('failed',))
+        print(queue.status())
+    elif args.command == 'worker':
+        stages = select_stages(args.stages)
+        if 1 in stages and args.regions_dir is None:
+            parser.error('--regions_dir is required when stage 1 runs')
+        worker_kwargs = dict(
+            stages=stages, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts,
+            data_json_path=args.data_json_path, regions_dir=args.regions_dir, output_dir=args.output_dir,
+            min_slu_count=args.min_slu_count, streaming=args.streaming, zonal_engine=args.zonal_engine, feature_backend=args.feature_backend,
+        )
+        if args.workers > 1:
+            run_local_workers(args.workers, args.queue, **worker_kwargs)
+        else:
+            run_worker(args.queue, **worker_kwargs)
+    else:
+        queue = RegionQueue(args.queue)
+        print(json.dumps(queue.status()))
+        for region_id, error in queue.failures().items():
+            print(f'{region_id}: {error.strip().splitlines()[-1] if error else ""}')
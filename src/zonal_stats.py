@@ -0,0 +1,186 @@
+import numpy as np
+
+ZONAL_STATS = ('count', 'sum', 'mean', 'var', 'min', 'max', 'mode')
+
+# pixels per row chunk fed to the accumulator, bounding the temporaries of one update
+ZONAL_CHUNK_PIXELS = 1 << 22
+
+def count_units(slope_units):
+    """
+    Number of slope units as understood by the per-unit tables: the number of
+    distinct values in the raster (unit i+1 lives in row i of every table).
+    """
+    return len(np.unique(slope_units))
+
+def row_chunks(shape, chunk_pixels=ZONAL_CHUNK_PIXELS):
+    """(start, stop) row ranges of a 2D raster holding roughly chunk_pixels pixels each."""
+    height, width = shape
+    rows = max(1, chunk_pixels // max(1, width))
+    return [(start, min(start + rows, height)) for start in range(0, height, rows)]
+
+def _group_starts(sorted_keys):
+    """Start offsets of each run of equal values in a sorted 1D array."""
+    if len(sorted_keys) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+
+def _value_histogram(unit_idx, values, weights=None):
+    """
+    Collapse (unit, value) pairs into unique (unit, value, count) runs, sorted
+    by unit then value. weights gives the multiplicity of each input pair.
+    """
+    order = np.lexsort((values, unit_idx))
+    u, v = unit_idx[order], values[order]
+    run_starts = np.flatnonzero(np.r_[True, (u[1:] != u[:-1]) | (v[1:] != v[:-1])]) if len(u) else np.zeros(0, dtype=np.int64)
+    if weights is None:
+        run_counts = np.diff(np.r_[run_starts, len(u)])
+    else:
+        run_counts = np.add.reduceat(weights[order], run_starts) if len(u) else np.zeros(0, dtype=np.int64)
+    return u[run_starts], v[run_starts], run_counts
+
+def _histogram_mode(units, values, counts, n_units):
+    """Most frequent value per unit of a (unit, value, count) histogram, ties going to the smallest value."""
+    out = np.zeros(n_units, dtype=np.float64)
+    # runs ordered by unit, then descending count, then ascending value
+    best = np.lexsort((values, -counts, units))
+    first = _group_starts(units[best])
+    out[units[best][first]] = values[best][first]
+    return out
+
+class ZonalAccumulator:
+    """
+    Running per-slope-unit statistics that can be fed a raster in pieces.
+
+    Each call to update() folds one window of (feature, label) pixels into
+    per-unit count, sum, mean/M2 (merged with Chan's parallel variance update),
+    min, max and, if 'mode' is requested, a (unit, value) histogram. Memory is
+    O(n_units) plus the histogram, independent of how many pixels are fed.
+    """
+
+    # compact the mode histogram once the pending triples exceed this many entries
+    HISTOGRAM_COMPACT_SIZE = 1 << 22
+
+    def __init__(self, n_units, stats=ZONAL_STATS):
+        stats = set(stats)
+        unknown = stats - set(ZONAL_STATS)
+        if unknown:
+            raise ValueError(f"Unknown zonal statistics: {sorted(unknown)}")
+        self.n_units = n_units
+        self.stats = stats
+        self.count = np.zeros(n_units, dtype=np.int64)
+        self.sum = np.zeros(n_units, dtype=np.float64)
+        self.mean = np.zeros(n_units, dtype=np.float64)
+        self.m2 = np.zeros(n_units, dtype=np.float64)
+        self.min = np.full(n_units, np.inf, dtype=np.float64)
+        self.max = np.full(n_units, -np.inf, dtype=np.float64)
+        self._histograms = []
+        self._histogram_size = 0
+
+    def update(self, raster, slope_units, nodata=None):
+        """
+        Fold one window (2D feature raster and matching label raster) into the
+        running statistics. Pixels equal to nodata (NaN allowed) are skipped.
+        """
+        labels = slope_units.ravel()
+        valid = (labels >= 1) & (labels <= self.n_units)
+        if nodata is not None:
+            pixels = raster.ravel()
+            valid &= ~np.isnan(pixels) if np.isnan(nodata) and pixels.dtype.kind == 'f' else pixels != nodata
+        unit_idx = labels[valid].astype(np.int64) - 1
+        values = raster.ravel()[valid].astype(np.float64)
+        if len(values) == 0:
+            return
+
+        n_b = np.bincount(unit_idx, minlength=self.n_units)
+        seen = n_b > 0
+        if self.stats & {'sum', 'mean', 'var'}:
+            sum_b = np.bincount(unit_idx, weights=values, minlength=self.n_units)
+            self.sum += sum_b
+            mean_b = np.zeros(self.n_units, dtype=np.float64)
+            mean_b[seen] = sum_b[seen] / n_b[seen]
+            if 'var' in self.stats:
+                # two-pass M2 within the window, avoids the cancellation of E[x^2] - E[x]^2
+                m2_b = np.bincount(unit_idx, weights=(values - mean_b[unit_idx]) ** 2, minlength=self.n_units)
+                n_a, n = self.count[seen], self.count[seen] + n_b[seen]
+                delta = mean_b[seen] - self.mean[seen]
+                self.m2[seen] += m2_b[seen] + delta ** 2 * n_a * n_b[seen] / n
+            total = self.count + n_b
+            self.mean[seen] = self.sum[seen] / total[seen]
+        if self.stats & {'min', 'max'}:
+            order = np.argsort(unit_idx, kind='stable')
+            sorted_units, sorted_values = unit_idx[order], values[order]
+            starts = _group_starts(sorted_units)
+            units_present = sorted_units[starts]
+            if 'min' in self.stats:
+                self.min[units_present] = np.minimum(self.min[units_present], np.minimum.reduceat(sorted_values, starts))
+            if 'max' in self.stats:
+                self.max[units_present] = np.maximum(self.max[units_present], np.maximum.reduceat(sorted_values, starts))
+        if 'mode' in self.stats:
+            self._histograms.append(_value_histogram(unit_idx, values))
+            self._histogram_size += len(self._histograms[-1][0])
+            if self._histogram_size > self.HISTOGRAM_COMPACT_SIZE:
+                self._compact_histogram()
+        self.count += n_b
+
+    def _compact_histogram(self):
+        if len(self._histograms) <= 1:
+            return
+        units, values, counts = (np.concatenate(parts) for parts in zip(*self._histograms))
+        self._histograms = [_value_histogram(units, values, weights=counts)]
+        self._histogram_size = len(self._histograms[0][0])
+
+    def _mode(self):
+        """Most frequent value per unit, ties going to the smallest value (as scipy.stats.mode)."""
+        if not self._histograms:
+            return np.zeros(self.n_units, dtype=np.float64)
+        self._compact_histogram()
+        return _histogram_mode(*self._histograms[0], self.n_units)
+
+    def result(self, stats=None):
+        """
+        Returns:
+            dict: stat name -> array of length n_units, where index i holds
+                  unit i+1. Units without pixels are 0, matching map_raster_to_slu.
+        """
+        stats = self.stats if stats is None else set(stats)
+        present = self.count > 0
+        result = {}
+        if 'count' in stats:
+            result['count'] = self.count.copy()
+        if 'sum' in stats:
+            result['sum'] = self.sum.copy()
+        if 'mean' in stats:
+            result['mean'] = np.where(present, self.mean, 0.0)
+        if 'var' in stats:
+            result['var'] = np.zeros(self.n_units, dtype=np.float64)
+            result['var'][present] = self.m2[present] / self.count[present]
+        if 'min' in stats:
+            result['min'] = np.where(present, self.min, 0.0)
+        if 'max' in stats:
+            result['max'] = np.where(present, self.max, 0.0)
+        if 'mode' in stats:
+            result['mode'] = self._mode()
+        return result
+
+def zonal_stats(raster, slope_units, n_units=None, stats=ZONAL_STATS, nodata=None):
+    """
+    Per-slope-unit statistics of a feature raster in a single linear pass,
+    fed to the accumulator in row chunks so no full-raster copy is made.
+
+    Args:
+        raster (numpy.ndarray): 2D feature raster, any numeric dtype.
+        slope_units (numpy.ndarray): 2D label raster of the same shape.
+        n_units (int): Table length; defaults to count_units(slope_units).
+        stats (iterable of str): Subset of ZONAL_STATS to compute.
+        nodata (number): Raster value (NaN allowed) excluded from every statistic.
+
+    Returns:
+        dict: stat name -> array of length n_units, where index i holds unit
+              i+1. Units without pixels are 0, matching map_raster_to_slu.
+    """
+    if n_units is None:
+        n_units = count_units(slope_units)
+    accumulator = ZonalAccumulator(n_units, stats=stats)
+    for start, stop in row_chunks(slope_units.shape):
+        accumulator.update(raster[start:stop], slope_units[start:stop], nodata=nodata)
+    return accumulator.result()